@@ -6,8 +6,13 @@ import json
 import os
 import re
 import sys
+import time
 
 import piro.config as conf
+from piro.history import HistoryStore
+from piro.orchestrate import Orchestrator, closure
+from piro.rollout import Rollout, RolloutAborted, parse_waves
+from piro.util.conformance import ConformanceHarness, SimulatedBackend
 
 
 def get_class(service):
@@ -33,6 +38,139 @@ def get_class(service):
     return getattr(module, klass)
 
 
+def get_control_name(service):
+    """
+    Given a service name, return the name used by the underlying
+    service control mechanism for that service according to the
+    configured aliases.
+    """
+    try:
+        return conf.ALIAS_MAP[service]
+    except KeyError:
+        return service
+
+
+def get_service_args(service, svc_args):
+    """
+    Return the arguments for the given service: those given on the
+    command line, or if there are none, those configured for the
+    service in ``SERVICE_ARGS``.
+    """
+    if svc_args:
+        return svc_args
+    return conf.SERVICE_ARGS.get(service, [])
+
+
+def get_service(service, control_name, svc_args, history=None):
+    """
+    Return an instance of the configured Service class for the given
+    service. If a history store is given, and the service supports
+    it, every status fetched for the service is recorded there.
+    """
+    klass = get_class(service)
+    instance = klass(service, control_name=control_name, svc_args=svc_args)
+    if history is not None and hasattr(instance, 'history'):
+        instance.history = history
+    return instance
+
+
+def parse_time(value):
+    """
+    Parse a time given on the command line, either as seconds since the
+    epoch or as a local time of the form YYYY-MM-DDTHH:MM:SS.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        return time.mktime(time.strptime(value, '%Y-%m-%dT%H:%M:%S'))
+
+
+def query_history(history, control_name, svc_args):
+    """
+    Answer a query against the status history of a service, given
+    the query options in ``svc_args``, returning a list of records.
+    """
+    parser = ArgumentParser(prog='piro history')
+    parser.add_argument('--host', dest='hosts', nargs='+', default=None,
+                        help='Only show records for these hosts.')
+    parser.add_argument('--since', type=parse_time, default=None,
+                        help='Only show records from this time on.')
+    parser.add_argument('--until', type=parse_time, default=None,
+                        help='Only show records before this time.')
+    parser.add_argument('--transitions', nargs='?', const='run',
+                        choices=['enable', 'run'], default=None,
+                        help='Only show records where the run state (or '
+                        'the enable state) changed.')
+    args = parser.parse_args(svc_args)
+    if args.transitions is None:
+        records = history.query(control_name, hosts=args.hosts,
+                                since=args.since, until=args.until)
+    else:
+        records = history.transitions(
+            control_name, hosts=args.hosts, since=args.since,
+            until=args.until,
+            component=['enable', 'run'].index(args.transitions))
+    result = []
+    for when, host, status in records:
+        status['time'] = when
+        status['host'] = host
+        result.append(status)
+    return result
+
+
+def conform(klass, service, control_name, svc_args):
+    """
+    Run the conformance harness against the service controller
+    ``klass``, given the harness options in ``svc_args``, returning
+    the harness's report. Any other options in ``svc_args`` are passed
+    on to the service controller, along with the simulated hosts and
+    the port they listen on, in the form the Monit class expects, and
+    the URL of the simulated M/Monit server if there is one.
+    """
+    parser = ArgumentParser(prog='piro conform')
+    parser.add_argument('--hosts', type=int, default=10,
+                        help='Number of hosts to simulate.')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Mean seconds taken by a simulated host to '
+                        'answer a request.')
+    parser.add_argument('--jitter', type=float, default=0.001,
+                        help='Standard deviation of the seconds taken by '
+                        'a simulated host to answer a request.')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of requests which fail.')
+    parser.add_argument('--action-delay', type=float, default=0.05,
+                        help='Seconds an action takes to take effect.')
+    parser.add_argument('--iterations', type=int, default=3,
+                        help='Number of times to run each action.')
+    parser.add_argument('--conform-timeout', type=float, default=10,
+                        help='Seconds to wait for an action to take effect.')
+    parser.add_argument('--mmonit-hosts', type=int, default=0,
+                        help='Number of simulated hosts which report to a '
+                        'simulated M/Monit server, whose URL is passed on '
+                        'with --mmonit-url.')
+    args, svc_args = parser.parse_known_args(svc_args)
+    backend = SimulatedBackend(hosts=args.hosts, services=[control_name],
+                               latency=args.latency, jitter=args.jitter,
+                               failure_rate=args.failure_rate,
+                               action_delay=args.action_delay,
+                               mmonit_hosts=args.mmonit_hosts)
+
+    def factory(backend):
+        options = ['--port', str(backend.port)]
+        if backend.mmonit_url is not None:
+            options += ['--mmonit-url', backend.mmonit_url]
+        return klass(service, control_name=control_name,
+                     svc_args=backend.hosts + options + svc_args)
+    backend.start()
+    try:
+        harness = ConformanceHarness(factory, backend,
+                                     iterations=args.iterations,
+                                     timeout=args.conform_timeout)
+        return harness.run()
+    finally:
+        backend.stop()
+
+
 def plugins_list(name):
     __import__(name)
     module = sys.modules[name]
@@ -50,7 +188,8 @@ def main():
     parser = ArgumentParser(description='Intelligently control services.')
     parser.add_argument('action',
                         help='Name of the action you wish to perform on the '
-                        'given service, or "list" to list available plugins.')
+                        'given service, "list" to list available plugins, or '
+                        '"conform" to test the service\'s plugin.')
     parser.add_argument('service',
                         help='Name of the service you wish to control, or '
                         'if listing, name of the plugin you wish to list '
@@ -58,6 +197,44 @@ def main():
     parser.add_argument('-c', '--control-name', default=None,
                         help='Name used by the underlying service control '
                         'mechanism to identify the given service.')
+    parser.add_argument('-d', '--with-deps', action='store_true',
+                        help='Also control the services related to the '
+                        'given service in SERVICE_DEPS, in dependency '
+                        'order: its dependencies when starting, and the '
+                        'services depending on it when stopping or '
+                        'restarting.')
+    parser.add_argument('--timeout', type=int, default=60,
+                        help='With --with-deps, seconds to wait for each '
+                        'level of services to reach the desired state.')
+    parser.add_argument('--history', metavar='DIR', default=conf.HISTORY_DIR,
+                        help='Record every status fetched in the history '
+                        'kept in this directory. With the "history" action, '
+                        'query that history instead.')
+    parser.add_argument('--plan', action='store_true',
+                        help='Print the API calls needed to perform the '
+                        'action, without performing it.')
+    parser.add_argument('--apply-plan', metavar='FILE', default=None,
+                        help='Perform exactly the API calls listed in a '
+                        'plan previously printed by --plan.')
+    parser.add_argument('--canary', action='store_true',
+                        help='Perform the action progressively: on a '
+                        'canary group of hosts first, then on growing '
+                        'waves of hosts, aborting if a wave is unhealthy.')
+    parser.add_argument('--waves', type=parse_waves, default=Rollout.WAVES,
+                        help='With --canary, a comma-separated list of the '
+                        'number of hosts (or percentage of hosts, such as '
+                        '25%%) which should have been acted on by the end '
+                        'of each wave.')
+    parser.add_argument('--soak', type=int, default=30,
+                        help='With --canary, seconds to watch each wave '
+                        'before moving on to the next.')
+    parser.add_argument('--max-failure-rate', type=float, default=0.0,
+                        help='With --canary, the fraction of hosts in a '
+                        'wave which may fail before the rollout aborts.')
+    parser.add_argument('--max-flapping-rate', type=float, default=0.0,
+                        help='With --canary, the fraction of hosts in a '
+                        'wave which may flap (change pid or reset uptime) '
+                        'during the soak period before the rollout aborts.')
 
     if sys.argv[1] == 'list':
         try:
@@ -88,24 +265,85 @@ def main():
 
     args, svc_args = parser.parse_known_args()
     if args.control_name is None:
-        try:
-            args.control_name = conf.ALIAS_MAP[args.service]
-        except:
-            args.control_name = None
-    if args.control_name is None:
-        args.control_name = args.service
+        args.control_name = get_control_name(args.service)
+    history = None
+    if args.history is not None:
+        history = HistoryStore(args.history)
+
+    if args.action == 'history':
+        if history is None:
+            print('No history directory given with --history, and no '
+                  'HISTORY_DIR configured!')
+            return 1
+        print json.dumps(query_history(history, args.control_name, svc_args),
+                         sort_keys=True,
+                         indent=4)
+        return 0
+
     klass = get_class(args.service)
     
     if args.action == 'help':
         klass._init_parser().print_help()
         return 0
 
-    service = klass(args.service,
-                    control_name=args.control_name,
-                    svc_args=svc_args)
+    if args.action == 'conform':
+        report = conform(klass, args.service, args.control_name, svc_args)
+        print json.dumps(report, sort_keys=True, indent=4)
+        return report['violations'] and 1 or 0
+
+    svc_args = get_service_args(args.service, svc_args)
+    if args.with_deps:
+        names = closure(conf.SERVICE_DEPS, args.service,
+                        reverse=args.action != 'start')
+        services = {}
+        for name in names:
+            if name == args.service:
+                control_name = args.control_name
+                service_args = svc_args
+            else:
+                control_name = get_control_name(name)
+                # Related services usually run on other hosts, so they
+                # only share the command line's arguments if none are
+                # configured for them.
+                service_args = conf.SERVICE_ARGS.get(name, svc_args)
+            services[name] = get_service(name, control_name, service_args,
+                                         history)
+        orchestrator = Orchestrator(services, conf.SERVICE_DEPS,
+                                    timeout=args.timeout)
+        result = orchestrator.execute(args.action)
+    elif args.plan:
+        service = get_service(args.service, args.control_name, svc_args,
+                              history)
+        result = service.plan(args.action)
+    elif args.apply_plan is not None:
+        with open(args.apply_plan) as plan_file:
+            plan = json.load(plan_file)
+        if plan['action'] != args.action:
+            print('Plan %s is for action %s, not %s!' %
+                  (args.apply_plan, plan['action'], args.action))
+            return 1
+        service = get_service(args.service, args.control_name, svc_args,
+                              history)
+        result = service.execute_plan(plan)
+    elif args.canary:
+        service = get_service(args.service, args.control_name, svc_args,
+                              history)
+        rollout = Rollout(service, waves=args.waves, soak=args.soak,
+                          max_failure_rate=args.max_failure_rate,
+                          max_flapping_rate=args.max_flapping_rate)
+        try:
+            result = rollout.execute(args.action)
+        except RolloutAborted, error:
+            print('Rollout aborted: %s' % error)
+            print json.dumps(error.report, sort_keys=True, indent=4)
+            return 1
+    else:
+        service = get_service(args.service, args.control_name, svc_args,
+                              history)
+        result = getattr(service, args.action)()
 
     # Obviously I need to do something better than just printing out
     # the status dict here, but that polish can happen later.
-    print json.dumps(getattr(service, args.action)(),
+    print json.dumps(result,
                      sort_keys=True,
                      indent=4)
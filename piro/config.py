@@ -6,6 +6,9 @@ import os
 
 SERVICE_MAP = {}
 ALIAS_MAP = {}
+SERVICE_DEPS = {}
+SERVICE_ARGS = {}
+HISTORY_DIR = None
 
 try:
     execfile('/etc/piro/config.py')
@@ -0,0 +1,205 @@
+"""
+An append-only history of service status.
+
+Every status fetched for a service can be recorded in a
+:py:class:`HistoryStore`, so that it is possible to find out
+afterwards exactly when each host's service changed state - during a
+rollout, for example.
+
+Records are stored in compact fixed-width binary form, one file per
+service and host::
+
+  HISTORY_DIR/<service>/<host>.dat
+
+Records in each file are kept in time order, so the records for a
+host within a time range are found by binary search, and only the
+files for the requested service and hosts are ever read.
+"""
+from heapq import merge
+import os
+import struct
+from threading import Lock
+from time import time
+from urllib import quote, unquote
+
+RECORD = struct.Struct('<dbbiq')
+"""
+Layout of a record: time (seconds since the epoch), enable state, run
+state, pid and uptime. States are stored as 1 (True), 0 (False) or -1
+(None); a missing pid or uptime is stored as -1.
+"""
+
+_STATES = {True: 1, False: 0, None: -1}
+_VALUES = {1: True, 0: False, -1: None}
+
+
+def _pack(when, status):
+    """
+    Return the record for ``status`` at time ``when``.
+    """
+    enable, run = status['state']
+    return RECORD.pack(when, _STATES[enable], _STATES[run],
+                       status.get('pid', -1), status.get('uptime', -1))
+
+
+def _unpack(data, offset=0):
+    """
+    Return the time and status dict of the record at ``offset`` in
+    ``data``.
+    """
+    when, enable, run, pid, uptime = RECORD.unpack_from(data, offset)
+    status = {'state': (_VALUES[enable], _VALUES[run])}
+    if pid != -1:
+        status['pid'] = pid
+    if uptime != -1:
+        status['uptime'] = uptime
+    return when, status
+
+
+class HistoryStore(object):
+    """
+    Records service status over time and answers queries about it.
+    """
+
+    def __init__(self, path):
+        """
+        ``path``
+          Directory in which to keep the history.
+        """
+        self.path = path
+        self.last = {}
+        self._lock = Lock()
+
+    def _file(self, service, host):
+        """
+        Return the path of the file holding the history of ``service``
+        on ``host``.
+        """
+        return os.path.join(self.path, quote(service, safe=''),
+                            '%s.dat' % quote(host, safe=''))
+
+    def hosts(self, service):
+        """
+        Return the hosts for which there is history of ``service``.
+        """
+        directory = os.path.join(self.path, quote(service, safe=''))
+        if not os.path.isdir(directory):
+            return []
+        return sorted(unquote(name[:-len('.dat')])
+                      for name in os.listdir(directory)
+                      if name.endswith('.dat'))
+
+    def append(self, service, host, status, when=None):
+        """
+        Record ``status`` for ``service`` on ``host`` at time ``when``
+        (now, by default). Records are kept in time order; a record
+        older than the latest one for the same host is recorded at the
+        time of the latest one instead.
+        """
+        if when is None:
+            when = time()
+        path = self._file(service, host)
+        with self._lock:
+            if path not in self.last:
+                self.last[path] = self._latest(path)
+            when = max(when, self.last[path])
+            self.last[path] = when
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(path, 'ab') as history:
+                history.write(_pack(when, status))
+
+    def _latest(self, path):
+        """
+        Return the time of the last record in the file at ``path``, or
+        0 if there are none.
+        """
+        try:
+            with open(path, 'rb') as history:
+                history.seek(0, os.SEEK_END)
+                count = history.tell() // RECORD.size
+                if not count:
+                    return 0
+                history.seek((count - 1) * RECORD.size)
+                return _unpack(history.read(RECORD.size))[0]
+        except IOError:
+            return 0
+
+    def _search(self, history, count, when):
+        """
+        Return the index of the first record in ``history`` at or after
+        time ``when``.
+        """
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            history.seek(middle * RECORD.size)
+            if _unpack(history.read(RECORD.size))[0] < when:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _read(self, service, host, since, until, before=False):
+        """
+        Yield tuples of the form ``(time, host, status)`` for the
+        records of ``service`` on ``host`` between ``since`` and
+        ``until``. If ``before`` is True, the last record before
+        ``since`` is included too, if there is one.
+        """
+        try:
+            history = open(self._file(service, host), 'rb')
+        except IOError:
+            return
+        with history:
+            history.seek(0, os.SEEK_END)
+            count = history.tell() // RECORD.size
+            first = 0
+            if since is not None:
+                first = self._search(history, count, since)
+            last = count
+            if until is not None:
+                last = self._search(history, count, until)
+            if before and first > 0:
+                first -= 1
+            history.seek(first * RECORD.size)
+            data = history.read(max(0, last - first) * RECORD.size)
+        for offset in xrange(0, len(data), RECORD.size):
+            when, status = _unpack(data, offset)
+            yield when, host, status
+
+    def query(self, service, hosts=None, since=None, until=None):
+        """
+        Return an iterator over the records of ``service`` from
+        ``since`` (inclusive) to ``until`` (exclusive), as tuples of
+        the form ``(time, host, status)`` in time order. If ``hosts``
+        is given, only records for those hosts are returned.
+        """
+        if hosts is None:
+            hosts = self.hosts(service)
+        return merge(*[self._read(service, host, since, until)
+                       for host in hosts])
+
+    def transitions(self, service, hosts=None, since=None, until=None,
+                    component=1):
+        """
+        Return an iterator over the records of ``service`` from
+        ``since`` to ``until`` in which a component of the state
+        changed from the host's previous record. ``component`` is 0
+        for the enable state, or 1 (the default) for the run
+        state. Records are returned as by :py:meth:`query`.
+        """
+        if hosts is None:
+            hosts = self.hosts(service)
+
+        def changes(host):
+            # The host's first record ever counts as a transition.
+            previous = object()
+            for when, host, status in self._read(service, host, since,
+                                                 until, before=True):
+                state = status['state'][component]
+                if state is not previous and (since is None or when >= since):
+                    yield when, host, status
+                previous = state
+        return merge(*[changes(host) for host in hosts])
@@ -0,0 +1,175 @@
+"""
+Dependency-aware control of groups of services.
+
+Services frequently depend on one another: a database must be running
+before the application which uses it, which in turn must be running
+before the proxy in front of it. Dependencies are declared in the
+``SERVICE_DEPS`` configuration setting, a dict whose keys are service
+names and values are lists of the services they depend on::
+
+  SERVICE_DEPS = {'app': ['database'],
+                  'proxy': ['app']}
+
+The :py:class:`Orchestrator` arranges services into levels, where
+every service in a level depends only on services in earlier
+levels. Services within a level are controlled concurrently; each
+level must converge to the desired state before the next one is
+started. Services are stopped in the reverse order.
+"""
+from time import sleep, time
+
+from piro.service import STATE_CHECKS
+from piro.util.parallel import pmap
+
+
+class OrchestrationError(StandardError):
+    """
+    Error raised when a dependency graph is invalid, or a level of
+    services fails to reach the desired state.
+    """
+    pass
+
+
+def closure(graph, name, reverse=False):
+    """
+    Return the set of services reachable from ``name`` in the
+    dependency ``graph``, including ``name`` itself. If ``reverse`` is
+    True, follow dependencies backwards, returning ``name`` and every
+    service which depends on it instead.
+    """
+    if reverse:
+        edges = {}
+        for service, deps in graph.items():
+            for dep in deps:
+                edges.setdefault(dep, []).append(service)
+    else:
+        edges = graph
+    seen = set()
+    pending = [name]
+    while pending:
+        service = pending.pop()
+        if service not in seen:
+            seen.add(service)
+            pending.extend(edges.get(service, []))
+    return seen
+
+
+def levels(graph, names):
+    """
+    Arrange the services in ``names`` into topological levels
+    according to the dependency ``graph``, returning a list of lists
+    of service names. Dependencies on services which are not in
+    ``names`` are ignored. Raises :py:class:`OrchestrationError` if
+    the graph contains a cycle.
+    """
+    remaining = dict((name, set(graph.get(name, [])) & set(names))
+                     for name in names)
+    result = []
+    while remaining:
+        level = sorted(name for name, deps in remaining.items() if not deps)
+        if not level:
+            raise OrchestrationError('Dependency cycle between services: %s'
+                                     % ', '.join(sorted(remaining)))
+        result.append(level)
+        for name in level:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(level)
+    return result
+
+
+def host_states(status):
+    """
+    Given the result of calling ``status()`` on a service, return a
+    dict mapping each host to its state tuple. Services which control
+    a single host return a single status dict; these are reported
+    under the host ``None``.
+    """
+    if 'state' in status:
+        return {None: status['state']}
+    return dict((host, value['state']) for host, value in status.items())
+
+
+class Orchestrator(object):
+    """
+    Runs service actions across a group of inter-dependent services.
+    """
+
+    def __init__(self, services, graph, timeout=60, interval=1,
+                 workers=16):
+        """
+        ``services``
+          A dict whose keys are service names and values are
+          :py:class:`Service <piro.service.Service>` instances.
+        ``graph``
+          The dependency graph, in the same form as the
+          ``SERVICE_DEPS`` configuration setting.
+        ``timeout``
+          Seconds to wait for a level to converge before giving up.
+        ``interval``
+          Seconds to wait between status checks while waiting for a
+          level to converge.
+        ``workers``
+          Maximum number of services to control concurrently within
+          a level.
+        """
+        self.services = services
+        self.graph = graph
+        self.timeout = timeout
+        self.interval = interval
+        self.workers = workers
+
+    def plan(self, action):
+        """
+        Return the list of steps needed to perform ``action``
+        (``start``, ``stop`` or ``restart``) on every service. Each
+        step is a tuple of the form ``(action, names)``, where all of
+        the services in ``names`` may be controlled concurrently.
+        """
+        order = levels(self.graph, self.services.keys())
+        if action == 'start':
+            return [('start', level) for level in order]
+        elif action == 'stop':
+            return [('stop', level) for level in reversed(order)]
+        elif action == 'restart':
+            return self.plan('stop') + self.plan('start')
+        raise OrchestrationError('Action %s can not be orchestrated' % action)
+
+    def _converge(self, action, names):
+        """
+        Wait until every host of every service in ``names`` reports
+        the state desired by ``action``, returning the latest status
+        of each service. Raises :py:class:`OrchestrationError` naming
+        the hosts which did not converge within ``timeout`` seconds.
+        """
+        check = STATE_CHECKS[action]
+        deadline = time() + self.timeout
+        while True:
+            status = dict(zip(names, pmap(lambda name:
+                                          self.services[name].status(),
+                                          names, workers=self.workers)))
+            failed = ['%s on %s' % (name, host)
+                      for name in names
+                      for host, state in host_states(status[name]).items()
+                      if not check(state)]
+            if not failed:
+                return status
+            if time() >= deadline:
+                raise OrchestrationError('%s did not converge: %s' %
+                                         (action, ', '.join(sorted(failed))))
+            sleep(self.interval)
+
+    def execute(self, action):
+        """
+        Perform ``action`` on every service, one level at a time,
+        stopping at the first level which fails to converge. Returns
+        a dict whose keys are service names and values are the
+        result of calling ``status()`` on that service once its level
+        has converged.
+        """
+        status = {}
+        for step, names in self.plan(action):
+            pmap(lambda name: getattr(self.services[name], step)(),
+                 names, workers=self.workers)
+            status.update(self._converge(step, names))
+        return status
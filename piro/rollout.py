@@ -0,0 +1,201 @@
+"""
+Progressive rollout of risky actions across many hosts.
+
+Rather than restarting a service on every host at once, a
+:py:class:`Rollout` performs the action on a small canary group of
+hosts first and watches them for a soak period. If they stay healthy,
+the rollout widens to larger and larger waves of hosts. If too many
+hosts in a wave fail to reach the desired state, or flap (their pid
+changes or their uptime resets during the soak period), the rollout is
+aborted and the remaining hosts are left untouched.
+
+Rollouts work with any service which lists its hosts in a ``hosts``
+attribute, whose ``status()`` returns a dict keyed by host and whose
+actions accept a ``hosts`` argument, such as the built-in
+:py:class:`Monit class <piro.service.monit.Monit>`.
+"""
+from math import ceil
+from time import sleep, time
+
+from piro.service import STATE_CHECKS
+from piro.util.parallel import pmap
+
+
+class RolloutAborted(StandardError):
+    """
+    Error raised when a wave of a rollout is unhealthy. The ``report``
+    attribute holds the rollout report up to and including the failed
+    wave.
+    """
+
+    def __init__(self, message, report):
+        StandardError.__init__(self, message)
+        self.report = report
+
+
+def parse_waves(spec):
+    """
+    Parse a comma-separated list of wave sizes given on the command
+    line, such as ``1,5%,100%``. A number followed by ``%`` is a
+    percentage of all hosts; anything else is a number of hosts.
+    """
+    waves = []
+    for size in spec.split(','):
+        size = size.strip()
+        if size.endswith('%'):
+            waves.append(float(size[:-1]) / 100)
+        else:
+            waves.append(int(size))
+    return waves
+
+
+class Rollout(object):
+    """
+    Performs an action on a service in progressively larger waves of
+    hosts.
+    """
+
+    WAVES = [1, 0.05, 0.25, 1.0]
+    """
+    Default wave sizes: one canary host, then 5%, 25% and finally
+    100% of hosts.
+    """
+
+    def __init__(self, service, waves=WAVES, soak=30, interval=5,
+                 max_failure_rate=0.0, max_flapping_rate=0.0):
+        """
+        ``service``
+          The service to act on.
+        ``waves``
+          Sizes of the successive waves. Each size is the total
+          number of hosts which should have been acted on by the end
+          of that wave: an integer is a number of hosts, and a float
+          is a fraction of all hosts.
+        ``soak``
+          Seconds to watch each wave after acting on it.
+        ``interval``
+          Seconds between status checks during the soak period.
+        ``max_failure_rate``
+          Largest fraction of a wave's hosts which may fail to reach
+          the desired state without aborting the rollout.
+        ``max_flapping_rate``
+          Largest fraction of a wave's hosts which may flap during the
+          soak period without aborting the rollout.
+        """
+        self.service = service
+        self.waves = waves
+        self.soak = soak
+        self.interval = interval
+        self.max_failure_rate = max_failure_rate
+        self.max_flapping_rate = max_flapping_rate
+
+    def plan(self, hosts):
+        """
+        Divide ``hosts`` into waves, returning a list of lists of
+        hosts. Waves which would be empty are dropped, and any hosts
+        left over after the last wave form a final wave of their own.
+        """
+        hosts = sorted(hosts)
+        result = []
+        done = 0
+        for size in self.waves:
+            if isinstance(size, float):
+                size = int(ceil(size * len(hosts)))
+            size = min(size, len(hosts))
+            if size > done:
+                result.append(hosts[done:size])
+                done = size
+        if done < len(hosts):
+            result.append(hosts[done:])
+        return result
+
+    def _sample(self, hosts):
+        """
+        Return the status of the service on each of ``hosts``. Hosts
+        whose status can not be fetched are reported with an
+        ``error`` key and an unknown state.
+        """
+        def fetch(host):
+            try:
+                return self.service.status(hosts=[host])[host]
+            except Exception, error:
+                return {'state': (None, None), 'error': str(error)}
+        return dict(zip(hosts, pmap(fetch, hosts)))
+
+    def _soak(self, action, hosts):
+        """
+        Watch ``hosts`` for the soak period, returning a tuple of the
+        form ``(failed, flapping, status)`` where ``failed`` and
+        ``flapping`` are lists of hosts and ``status`` is the last
+        status sampled from each host.
+        """
+        check = STATE_CHECKS[action]
+        flapping = set()
+        # The pid of each host when it was first seen in the desired
+        # state; the action may still be taking effect before that.
+        pids = {}
+        uptimes = {}
+        deadline = time() + self.soak
+        while True:
+            status = self._sample(hosts)
+            for host in hosts:
+                pid = status[host].get('pid')
+                uptime = status[host].get('uptime')
+                if check(status[host]['state']):
+                    pids.setdefault(host, pid)
+                if pids.get(host) not in (None, pid):
+                    flapping.add(host)
+                if host in pids and uptime is not None:
+                    if uptime < uptimes.get(host, uptime):
+                        flapping.add(host)
+                    uptimes[host] = uptime
+            last = status
+            if time() >= deadline:
+                break
+            sleep(min(self.interval, max(0, deadline - time())))
+        failed = [host for host in hosts if not check(last[host]['state'])]
+        return failed, sorted(flapping), last
+
+    def execute(self, action):
+        """
+        Perform ``action`` on the service wave by wave. Returns a report
+        as a dict with the key ``waves``, a list with one dict per
+        wave holding the wave's ``hosts``, ``failed`` hosts,
+        ``flapping`` hosts and final ``status``. Raises
+        :py:class:`RolloutAborted` if a wave is unhealthy, or if
+        performing the action on a wave raises an error; the error is
+        recorded in the wave's report under ``error``.
+        """
+        if action not in STATE_CHECKS:
+            raise ValueError('Action %s can not be rolled out' % action)
+        check = STATE_CHECKS[action]
+        report = {'action': action, 'waves': []}
+        for wave in self.plan(self.service.hosts):
+            try:
+                getattr(self.service, action)(hosts=wave)
+            except Exception, error:
+                status = self._sample(wave)
+                failed = [host for host in wave
+                          if not check(status[host]['state'])]
+                report['waves'].append({'hosts': wave,
+                                        'failed': failed,
+                                        'flapping': [],
+                                        'status': status,
+                                        'error': str(error)})
+                raise RolloutAborted('%s raised an error on a wave of %d '
+                                     'hosts: %s' % (action, len(wave), error),
+                                     report)
+            failed, flapping, status = self._soak(action, wave)
+            report['waves'].append({'hosts': wave,
+                                    'failed': failed,
+                                    'flapping': flapping,
+                                    'status': status})
+            if len(failed) > self.max_failure_rate * len(wave):
+                raise RolloutAborted('%s failed on %d of %d hosts: %s' %
+                                     (action, len(failed), len(wave),
+                                      ', '.join(failed)), report)
+            if len(flapping) > self.max_flapping_rate * len(wave):
+                raise RolloutAborted('%s flapping on %d of %d hosts: %s' %
+                                     (action, len(flapping), len(wave),
+                                      ', '.join(flapping)), report)
+        return report
@@ -56,6 +56,17 @@ class HookError(StandardError):
     pass
 
 
+STATE_CHECKS = {'enable': lambda state: state[0] is True,
+                'disable': lambda state: state[0] is False,
+                'start': lambda state: state[1] is True,
+                'stop': lambda state: state[1] is False,
+                'restart': lambda state: state[1] is True}
+"""
+Predicates on a state tuple, by action, which are True once the
+action has taken effect.
+"""
+
+
 class Service(object):
     """
     Base class defining the service control API and providing
@@ -100,7 +111,7 @@ class Service(object):
         """
         # We only want to muck with method lookup for our API methods.
         if name in object.__getattribute__(self, 'HOOK_METHOD_NAMES'):
-            def fun():
+            def fun(*args, **kwargs):
                 """
                 Wraps a method call with pre/post hooks.
                 """
@@ -110,7 +121,7 @@ class Service(object):
                 # Store the result of calling the originally-requested
                 # method so we can return it as the return value of
                 # this function that wraps it.
-                result = object.__getattribute__(self, name)()
+                result = object.__getattribute__(self, name)(*args, **kwargs)
                 self._run_hooks('post_%s' % name)
                 return result
             return fun
@@ -0,0 +1,263 @@
+"""
+The mmonit module provides a built-in service control class for
+controlling services running under Monit_ through a central
+`M/Monit`_ server, rather than by contacting the Monit HTTP service on
+every host.
+
+The status of the service on every host is fetched with a single
+paged query, and actions are sent through the central server. The
+server is expected to provide the following API:
+
+``GET /status/services/list?service=NAME&startindex=N&results=M``
+  Returns a JSON document of the form ``{"totalRecords": T,
+  "records": [...]}``. Each record describes the service ``NAME`` on
+  one host, and has the keys ``hostid``, ``hostname``, ``monitor`` and
+  ``status`` (with the same meaning as the fields of the same names
+  in Monit's own status document), and optionally ``pid`` and
+  ``uptime``.
+
+``POST /admin/hosts/action``
+  Performs the action given by the ``action`` parameter (``start``,
+  ``stop``, ``monitor`` or ``unmonitor``) on the service given by the
+  ``service`` parameter on the host whose ``hostid`` is given by the
+  ``id`` parameter.
+
+Hosts the central server does not know about are controlled directly
+through their own Monit HTTP service, exactly as the :py:class:`Monit
+class <piro.service.monit.Monit>` would.
+
+.. _Monit: http://mmonit.com/monit/
+.. _M/Monit: http://mmonit.com/
+"""
+
+from contextlib import closing
+import json
+from threading import Lock
+from time import time
+from urllib import urlencode
+import urllib2 as url
+
+from piro.service.monit import Monit
+
+
+class MMonit(Monit):
+    """
+    Controls a service via a central M/Monit server, falling back to
+    the Monit web API on hosts the server does not know about.
+    """
+
+    @classmethod
+    def _init_parser(cls):
+        parser = Monit._init_parser()
+        parser.add_argument('--mmonit-url', required=True,
+                            help='Base URL of the M/Monit server, such as '
+                            'http://mmonit.example.com:8080')
+        parser.add_argument('--mmonit-username', default='',
+                            help='Username to use when authenticating to '
+                            'the M/Monit server.')
+        parser.add_argument('--mmonit-password', default='',
+                            help='Password to use when authenticating to '
+                            'the M/Monit server.')
+        parser.add_argument('--mmonit-page-size', type=int, default=500,
+                            help='Number of hosts to request from the '
+                            'M/Monit server at a time.')
+        parser.add_argument('--mmonit-max-age', type=float, default=0.5,
+                            help='Seconds for which status fetched from '
+                            'the M/Monit server may be reused.')
+        return parser
+
+    def __init__(self, name, control_name=None, svc_args=[]):
+        """
+        Initialize a service controlled through M/Monit.
+
+        ``name``
+          Human-friendly name for the service.
+        ``control_name``
+          Name that the underlying service control system uses to
+          identify the service.
+        ``svc_args``
+          Command-line arguments specific to this service, in the
+          format expected by argparse. M/Monit services accept all of
+          the options of :py:func:`Monit services
+          <piro.service.monit.Monit.__init__>`, which are used for
+          hosts unknown to the M/Monit server, and require the
+          following option:
+
+          ``--mmonit-url``
+            Base URL of the M/Monit server.
+
+          M/Monit services also use the following options, if
+          provided:
+
+          ``--mmonit-username``
+            Username to use when authenticating to the M/Monit server.
+          ``--mmonit-password``
+            Password to use when authenticating to the M/Monit server.
+          ``--mmonit-page-size``
+            Number of hosts to request from the M/Monit server at a
+            time.
+          ``--mmonit-max-age``
+            Seconds for which status fetched from the M/Monit server
+            may be reused. Status for every host is fetched at once,
+            so each action decides which hosts to act on from a single
+            query, and concurrent checks of many hosts share one
+            query.
+
+          Requests to the M/Monit server use the same timeouts and
+          retries as requests to the hosts; their timeouts are derived
+          from the server's own past response times. Host names are
+          only resolved for hosts the M/Monit server turns out not to
+          know about, unless ``--collector-port`` is given, since
+          pushed status is matched to a host by its address.
+        """
+        self.hostids = {}
+        self.records = {}
+        self.fetched = None
+        self._lock = Lock()
+        Monit.__init__(self, name, control_name=control_name,
+                       svc_args=svc_args)
+        args = self._init_parser().parse_known_args(svc_args)[0]
+        self.mmonit_url = args.mmonit_url.rstrip('/')
+        self.page_size = args.mmonit_page_size
+        self.max_age = args.mmonit_max_age
+        passwords = url.HTTPPasswordMgrWithDefaultRealm()
+        passwords.add_password(realm=None, uri=self.mmonit_url,
+                               user=args.mmonit_username,
+                               passwd=args.mmonit_password)
+        # Keep a separate opener so the M/Monit credentials and session
+        # cookie are never sent to the hosts themselves.
+        self.mmonit_opener = url.build_opener(
+            url.HTTPBasicAuthHandler(passwords), url.HTTPCookieProcessor())
+
+    def _direct_hosts(self):
+        """
+        Return the hosts the M/Monit server does not know about, which
+        are controlled through their own Monit HTTP service. Until the
+        server has been asked, that is none of them - unless there is
+        a collector, which needs the address of every host.
+        """
+        if self.collector is not None:
+            return self.hosts
+        if self.fetched is None:
+            return []
+        return [host for host in self.hosts if host not in self.records]
+
+    def _mmonit_request(self, path, data=None):
+        """
+        Perform a request against the M/Monit server, retrying
+        transient failures, and return a tuple of the form ``(body,
+        retries)``. The timeout for each request is derived from the
+        server's past response times, and doubles with each retry.
+        """
+        def fetch(timeout):
+            with closing(self.mmonit_opener.open(
+                    '%s/%s' % (self.mmonit_url, path), data,
+                    timeout=timeout)) as res:
+                return res.read()
+        return self._call(self.mmonit_url, fetch)
+
+    def _refresh(self, since=None):
+        """
+        Fetch the status of the service on every host known to the
+        M/Monit server, one page at a time, unless it has already been
+        fetched - at or after time ``since``, if given. Concurrent
+        callers share a single fetch. Retries needed to fetch the
+        status are counted against every host it covers, and hosts the
+        server does not know about are connected to directly.
+        """
+        with self._lock:
+            if (self.fetched is not None and
+                (since is None or self.fetched >= since)):
+                return
+            # Status fetched while an action is being sent may predate
+            # it, so a fetch counts from the time it began.
+            begin = time()
+            records = {}
+            hostids = {}
+            retries = 0
+            start = 0
+            while True:
+                query = urlencode({'service': self.control_name,
+                                   'startindex': start,
+                                   'results': self.page_size})
+                body, page_retries = self._mmonit_request(
+                    'status/services/list?%s' % query)
+                page = json.loads(body)
+                retries += page_retries
+                for record in page['records']:
+                    records[record['hostname']] = record
+                    hostids[record['hostname']] = record['hostid']
+                start += len(page['records'])
+                if not page['records'] or start >= page['totalRecords']:
+                    break
+            self.records = records
+            self.hostids = hostids
+            self.fetched = begin
+            for host in self.hosts:
+                if host in records:
+                    self.retries[host] += retries
+            self._connect(self._direct_hosts())
+
+    def _each_host(self, fun, hosts=None, status=True):
+        """
+        Fetch the status of the service from the M/Monit server, unless
+        it was fetched less than ``--mmonit-max-age`` seconds ago, then
+        call ``fun`` for each host as :py:func:`Monit._each_host()
+        <piro.service.monit.Monit._each_host>` does. Every decision
+        made for a host which has not been acted on since is based on
+        this one fetch.
+        """
+        if status:
+            self._refresh(time() - self.max_age)
+        return Monit._each_host(self, fun, hosts=hosts, status=status)
+
+    def _status(self, host, pushed=True):
+        """
+        Returns the status of the service as a dict, from the M/Monit
+        server if it knows about the host, and from the host's own
+        Monit HTTP service otherwise.
+        """
+        if host in self.sent:
+            # The state of the service on this host is changing, so
+            # status fetched before the action was sent is of no use,
+            # and status is fetched again if it is more than
+            # --mmonit-max-age seconds old. However many hosts are
+            # waiting for a change, that is one fetch every
+            # --mmonit-max-age seconds.
+            self._refresh(max(self.sent[host], time() - self.max_age))
+        else:
+            self._refresh()
+        if host not in self.records:
+            return Monit._status(self, host, pushed=pushed)
+        record = self.records[host]
+        status = {'state': self._monit_state(int(record['monitor']),
+                                             int(record['status']))}
+        for key in ('pid', 'uptime'):
+            if record.get(key) is not None:
+                status[key] = int(record[key])
+        return self._record(host, status)
+
+    def _send(self, host, action):
+        """
+        Send the given Monit action for the service to the given host,
+        through the M/Monit server if it knows about the host.
+        """
+        self._refresh()
+        if host not in self.hostids:
+            return Monit._send(self, host, action)
+        self.sent[host] = time()
+        retries = self._mmonit_request(
+            'admin/hosts/action', urlencode({'id': self.hostids[host],
+                                             'service': self.control_name,
+                                             'action': action}))[1]
+        self.retries[host] += retries
+
+    def plan(self, action):
+        """
+        Plan ``action`` as :py:func:`Monit.plan()
+        <piro.service.monit.Monit.plan>` does, from the status of the
+        service fetched from the M/Monit server in a single paged
+        query.
+        """
+        self._refresh(time() - self.max_age)
+        return Monit.plan(self, action)
@@ -8,12 +8,20 @@ services are exposed remotely by the `Monit HTTP service`_.
 """
 
 from contextlib import closing
-from time import sleep
+import os
+import socket
+from threading import Lock
+from time import sleep, time
 from urllib import urlencode
 import urllib2 as url
 from xml.etree import ElementTree
 
-from piro.service import Service
+from piro.collector import StatusCollector
+from piro.service import STATE_CHECKS, Service
+from piro.util.latency import LatencyTracker, hedged
+from piro.util.parallel import pmap
+from piro.util.resolve import Resolver
+from piro.util.retry import RetryBudget, RetryPolicy
 
 
 class MonitAPIError(StandardError):
@@ -24,11 +32,29 @@ class MonitAPIError(StandardError):
     pass
 
 
+class UnresolvedHostError(MonitAPIError):
+    """
+    Error raised when attempting to contact a host whose name could
+    not be resolved.
+    """
+    pass
+
+
 class Monit(Service):
     """
     Controls a service via the Monit web API.
     """
 
+    ACTIONS = {'enable': ('monitor', STATE_CHECKS['enable']),
+               'disable': ('unmonitor', STATE_CHECKS['disable']),
+               'start': ('start', STATE_CHECKS['start']),
+               'stop': ('stop', STATE_CHECKS['stop'])}
+    """
+    Maps each Service API action to the Monit HTTP API action which
+    performs it, and a function which returns True when given a state
+    tuple in which the action has taken effect.
+    """
+
     @classmethod
     def _init_parser(cls):
         parser = Service._init_parser()
@@ -47,6 +73,82 @@ class Monit(Service):
         parser.add_argument('--realm', default='monit',
                             help='Authentication realm to use when '
                             'authenticating to the Monit API.')
+        parser.add_argument('--retries', type=int, default=3,
+                            help='Maximum number of attempts for each '
+                            'Monit API request.')
+        parser.add_argument('--retry-backoff', type=float, default=0.1,
+                            help='Seconds to wait before the first retry; '
+                            'doubles with each further retry.')
+        parser.add_argument('--retry-codes', type=int, nargs='*',
+                            default=[502, 503, 504],
+                            help='HTTP status codes which should be '
+                            'retried.')
+        parser.add_argument('--retry-budget', type=float, default=0.2,
+                            help='Number of retries permitted per request '
+                            'made, across all hosts.')
+        parser.add_argument('--workers', type=int, default=16,
+                            help='Maximum number of hosts to contact '
+                            'concurrently.')
+        parser.add_argument('--cache-dir', default=None,
+                            help='Directory in which to keep information '
+                            'about hosts, such as their response times, '
+                            'between runs.')
+        parser.add_argument('--resolve-ttl', type=float, default=300,
+                            help='Seconds for which resolved host addresses '
+                            'may be reused.')
+        parser.add_argument('--no-resolve', dest='resolve',
+                            action='store_false',
+                            help='Look up host names on every request '
+                            'instead of resolving them all up front.')
+        parser.add_argument('--timeout-floor', type=float, default=0.2,
+                            help='Shortest timeout, in seconds, for Monit '
+                            'API requests.')
+        parser.add_argument('--timeout-ceiling', type=float, default=5.0,
+                            help='Longest timeout, in seconds, for Monit '
+                            'API requests.')
+        parser.add_argument('--hedge', action='store_true',
+                            help='Send a second status request to hosts '
+                            'which are slower than usual to answer the '
+                            'first.')
+        parser.add_argument('--wait-timeout', type=float, default=300,
+                            help='Longest time, in seconds, to wait for the '
+                            'service to reach the desired state on a host.')
+        parser.add_argument('--max-load', type=float, default=None,
+                            help='Delay starting or restarting the service '
+                            'on hosts whose 1 minute load average is above '
+                            'this value.')
+        parser.add_argument('--max-memory', type=float, default=None,
+                            help='Delay starting or restarting the service '
+                            'on hosts whose memory usage is above this '
+                            'percentage.')
+        parser.add_argument('--throttle-interval', type=float, default=5,
+                            help='Seconds between checks of the load on a '
+                            'host while starting or restarting the service '
+                            'is delayed.')
+        parser.add_argument('--throttle-timeout', type=float, default=300,
+                            help='Longest time, in seconds, to delay '
+                            'starting or restarting the service on a busy '
+                            'host.')
+        parser.add_argument('--collector-port', type=int, default=None,
+                            help='Listen on this port for status pushed '
+                            'by Monit, instead of polling hosts which '
+                            'push their status.')
+        parser.add_argument('--collector-address', default='127.0.0.1',
+                            help='Address on which to listen for status '
+                            'pushed by Monit.')
+        parser.add_argument('--collector-username', default=None,
+                            help='Username Monit must give when pushing '
+                            'its status.')
+        parser.add_argument('--collector-password', default=None,
+                            help='Password Monit must give when pushing '
+                            'its status.')
+        parser.add_argument('--collector-max-age', type=float, default=5,
+                            help='Seconds for which status pushed by Monit '
+                            'is used instead of polling the host.')
+        parser.add_argument('--collector-poll', type=float, default=5,
+                            help='Seconds to wait for Monit to push a state '
+                            'change before polling the host to check, on '
+                            'hosts which have pushed their status before.')
         return parser
 
     def __init__(self, name, control_name=None, svc_args=[]):
@@ -74,6 +176,87 @@ class Monit(Service):
           ``--realm``
             Authentication realm to use when authenticating to the Monit
             HTTP API.
+          ``--retries``
+            Maximum number of attempts for each Monit HTTP API request.
+          ``--retry-backoff``
+            Seconds to wait before the first retry.
+          ``--retry-codes``
+            HTTP status codes which should be retried.
+          ``--retry-budget``
+            Number of retries permitted per request made, across all
+            hosts. This keeps retries from overwhelming hosts which are
+            already struggling.
+          ``--workers``
+            Maximum number of hosts to contact concurrently.
+          ``--cache-dir``
+            Directory in which to keep information about hosts between
+            runs, such as their response times.
+          ``--resolve-ttl``
+            Seconds for which resolved host addresses may be reused.
+            Host names are resolved concurrently when the service is
+            created, and kept in ``--cache-dir`` if given. Every address
+            of a host is kept, and if the host refuses connections on
+            one, the next is tried. Hosts which can not be resolved are
+            reported in the result of each action with an ``error`` key
+            and an unknown state, without being contacted.
+          ``--no-resolve``
+            Look up host names on every request instead.
+          ``--timeout-floor``, ``--timeout-ceiling``
+            Bounds, in seconds, on the timeout for Monit HTTP API
+            requests. Within these bounds, the timeout for each host is
+            derived from its past response times, and doubles with each
+            retry of a request.
+          ``--hedge``
+            If a host takes longer than its 95th percentile response
+            time to answer a status request, send a second request and
+            use whichever answer arrives first.
+          ``--wait-timeout``
+            Longest time, in seconds, to wait for the service to reach
+            the desired state on a host when waiting for an action.
+          ``--max-load``
+            Delay starting or restarting the service on hosts whose 1
+            minute load average is above this value.
+          ``--max-memory``
+            Delay starting or restarting the service on hosts whose
+            memory usage is above this percentage.
+          ``--throttle-interval``
+            Seconds between checks of the load on a host while
+            starting or restarting the service is delayed.
+          ``--throttle-timeout``
+            Longest time, in seconds, to delay starting or restarting
+            the service on a busy host. The service is started (or
+            restarted) anyway once this time has passed.
+
+          If ``--max-load`` or ``--max-memory`` is given, hosts are
+          also started and restarted in order of increasing load. A
+          busy host is restarted only once it has calmed down, so the
+          service is never left stopped on it while waiting.
+
+          ``--collector-port``
+            Listen on this port for status pushed by Monit (see
+            :py:mod:`piro.collector`). Hosts which push their status
+            are not polled while it is fresh, and waiting for a state
+            change completes as soon as the change is pushed. A host
+            which pushes its status is only polled while waiting if
+            nothing has been pushed for ``--collector-poll`` seconds;
+            hosts which have never pushed are polled as usual. Status
+            is matched to a host by the address it was pushed from, so
+            with ``--no-resolve`` hosts must be given by address.
+          ``--collector-address``
+            Address on which to listen for status pushed by Monit; the
+            loopback address by default, so for Monit on other hosts to
+            reach the collector, give an address they can reach.
+          ``--collector-username``, ``--collector-password``
+            If given, status pushed without these HTTP Basic
+            Authentication credentials is refused.
+          ``--collector-max-age``
+            Seconds for which status pushed by Monit is used instead of
+            polling the host. Status pushed before the last action sent
+            to a host is never used.
+          ``--collector-poll``
+            Seconds to wait for Monit to push a state change before
+            polling the host to check, on hosts which have pushed their
+            status before.
 
         .. _argparse: http://docs.python.org/library/argparse.html
         """
@@ -81,19 +264,232 @@ class Monit(Service):
         self.auth = url.HTTPBasicAuthHandler()
         self.opener = None
         self.uri = {}
+        self.host_metrics = {}
         parser = self._init_parser()
         args = parser.parse_known_args(svc_args)[0]
-        for host in args.hosts:
-            self.uri[host] = 'http://%s:%s' % (host, args.port)
-            # Configure HTTP Basic Authentication for the Monit web API.
-            self.auth.add_password(realm=args.realm,
-                                   uri=self.uri[host],
-                                   user=args.username,
-                                   passwd=args.password)
+        self.workers = args.workers
+        self.hosts = list(args.hosts)
+        self.retries = dict((host, 0) for host in self.hosts)
+        self.port = args.port
+        self.realm = args.realm
+        self.username = args.username
+        self.password = args.password
+        cache = None
+        if args.cache_dir is not None:
+            cache = os.path.join(args.cache_dir, 'latency.json')
+        self.latency = LatencyTracker(path=cache, floor=args.timeout_floor,
+                                      ceiling=args.timeout_ceiling)
+        self.hedge = args.hedge
+        self.wait_timeout = args.wait_timeout
+        self.max_load = args.max_load
+        self.max_memory = args.max_memory
+        self.throttle_interval = args.throttle_interval
+        self.throttle_timeout = args.throttle_timeout
+        self.history = None
+        self.sent = {}
+        self.collector = None
+        if args.collector_port is not None:
+            self.collector = StatusCollector.get(
+                args.collector_port, args.collector_address,
+                username=args.collector_username,
+                password=args.collector_password)
+        self.collector_max_age = args.collector_max_age
+        self.collector_poll = args.collector_poll
+        self.retry = RetryPolicy(attempts=args.retries,
+                                 backoff=args.retry_backoff,
+                                 codes=args.retry_codes,
+                                 budget=RetryBudget(ratio=args.retry_budget))
+        self.resolver = None
+        if args.resolve:
+            cache = None
+            if args.cache_dir is not None:
+                cache = os.path.join(args.cache_dir, 'hosts.json')
+            self.resolver = Resolver(path=cache, ttl=args.resolve_ttl)
+        self.unresolved = {}
+        self.headers = {}
+        self.addresses = {}
+        self.candidates = {}
+        self._connecting = Lock()
         self.opener = url.build_opener(self.auth)
         url.install_opener(self.opener)
+        self._connect(self._direct_hosts())
+
+    def _direct_hosts(self):
+        """
+        Return the hosts which are controlled through their own Monit
+        HTTP service, and so should be connected to up front.
+        """
+        return self.hosts
+
+    def _connect(self, hosts):
+        """
+        Prepare to contact the Monit HTTP service on each of the given
+        hosts which has not been connected to already: resolve their
+        names, unless ``--no-resolve`` was given, and set up the URI,
+        headers and credentials for their requests. Names are resolved
+        concurrently; hosts whose names can not be resolved are
+        recorded in ``self.unresolved``. Every address of each host is
+        kept in ``self.candidates``, and requests go to the first until
+        it refuses a connection.
+        """
+        with self._connecting:
+            hosts = [host for host in hosts if host not in self.uri]
+            if not hosts:
+                return
+            addresses = {}
+            if self.resolver is not None:
+                addresses, unresolved = self.resolver.resolve_all(
+                    hosts, self.port, workers=self.workers)
+                self.unresolved.update(unresolved)
+                self.resolver.save()
+            for host in hosts:
+                self.candidates[host] = addresses.get(host) or [host]
+                # Requests go to the resolved address, but Monit should
+                # still see the name it was asked for.
+                self.headers[host] = {'Host': '%s:%s' % (host, self.port)}
+                # Configure HTTP Basic Authentication for the Monit web
+                # API, on whichever address is used.
+                for address in self.candidates[host]:
+                    self.auth.add_password(realm=self.realm,
+                                           uri=self._address_uri(address),
+                                           user=self.username,
+                                           passwd=self.password)
+                # Set last, since a host with a URI counts as connected.
+                self._use(host, self.candidates[host][0])
+
+    def _address_uri(self, address):
+        """
+        Return the base URI of the Monit HTTP service at ``address``.
+        """
+        if ':' in address:
+            address = '[%s]' % address
+        return 'http://%s:%s' % (address, self.port)
+
+    def _use(self, host, address):
+        """
+        Send requests for the given host to ``address`` from now on.
+        """
+        self.addresses[host] = address
+        self.uri[host] = self._address_uri(address)
+
+    def _request(self, host, path, data=None):
+        """
+        Perform a request against the Monit HTTP API on the given host
+        and return the body of the response. Transient failures are
+        retried according to the service's retry policy; retries are
+        counted per host in ``self.retries``. The timeout for each
+        request is derived from the host's past response times, and
+        doubles with each retry.
+        """
+        if host not in self.uri:
+            self._connect([host])
+        if host in self.unresolved:
+            raise UnresolvedHostError('Could not resolve %s: %s' %
+                                      (host, self.unresolved[host]))
+
+        def fetch(timeout):
+            tried = set()
+            while True:
+                address = self.addresses[host]
+                tried.add(address)
+                request = url.Request('%s/%s' % (self.uri[host], path),
+                                      data, self.headers[host])
+                try:
+                    with closing(url.urlopen(request,
+                                             timeout=timeout)) as res:
+                        return res.read()
+                except url.URLError, error:
+                    # If the host refuses connections on this address,
+                    # try its others, as connecting by name would; the
+                    # first which works is used from then on.
+                    reason = getattr(error, 'reason', None)
+                    untried = [candidate
+                               for candidate in self.candidates[host]
+                               if candidate not in tried]
+                    if (not isinstance(reason, socket.error) or
+                        isinstance(reason, socket.timeout) or
+                        not untried):
+                        raise
+                    self._use(host, untried[0])
+
+        # Only status requests are hedged; sending an action twice
+        # would be harmless, but would double the load on a host which
+        # is already slow.
+        body, retries = self._call(host, fetch,
+                                   hedge=self.hedge and data is None)
+        self.retries[host] += retries
+        return body
+
+    def _call(self, key, fetch, hedge=False):
+        """
+        Call ``fetch``, retrying transient failures according to the
+        service's retry policy, and return a tuple of the form
+        ``(result, retries)``. ``fetch`` is given a timeout derived
+        from the past response times recorded under ``key`` (the host,
+        or server, being contacted), doubled for each retry, and how
+        long it takes is recorded. If ``hedge`` is True, a second call
+        is made if the first is slower than usual.
+        """
+        attempts = [0]
+
+        def timed():
+            timeout = self.latency.timeout(key, attempt=attempts[0])
+            begin = time()
+            try:
+                result = fetch(timeout)
+            except (socket.timeout, url.URLError), error:
+                # A timeout tells us the host took at least that long.
+                if (isinstance(error, socket.timeout) or
+                    isinstance(getattr(error, 'reason', None),
+                               socket.timeout)):
+                    self.latency.observe(key, timeout)
+                raise
+            self.latency.observe(key, time() - begin)
+            return result
 
-    def _api_call(self, host, action, check_fn, wait=False):
+        def attempt():
+            try:
+                if hedge:
+                    return hedged(timed, self.latency.p95(key))
+                return timed()
+            finally:
+                attempts[0] += 1
+        return self.retry.call(attempt)
+
+    def _each_host(self, fun, hosts=None, status=True):
+        """
+        Call ``fun`` for each host, up to ``--workers`` hosts at a
+        time, returning a dict whose keys are the host names and
+        values are the status dictionaries returned by ``fun``. The
+        number of retries made against each host is recorded in its
+        status dictionary under ``retries``. Hosts whose names could
+        not be resolved are reported with an ``error`` key and an
+        unknown state. If ``hosts`` is given, only those hosts are
+        used. If ``status`` is False, ``fun`` returns dicts other than
+        status dictionaries, and neither the number of retries nor a
+        state is added to them.
+        """
+        if hosts is None:
+            hosts = self.hosts
+        unknown = set(hosts) - set(self.hosts)
+        if unknown:
+            raise MonitAPIError('Unknown hosts: %s' %
+                                ', '.join(sorted(unknown)))
+        def each(host):
+            try:
+                return fun(host)
+            except UnresolvedHostError, error:
+                if not status:
+                    return {'error': str(error)}
+                return {'state': (None, None), 'error': str(error)}
+        result = dict(zip(hosts, pmap(each, hosts, workers=self.workers)))
+        if status:
+            for host in hosts:
+                result[host]['retries'] = self.retries[host]
+        self.latency.save()
+        return result
+
+    def _api_call(self, host, action, check_fn, wait=False, throttle=False):
         """
         Given an action, perform the actual Monit API call for that
         action, optionally waiting for the state change to occur. This
@@ -101,24 +497,129 @@ class Monit(Service):
         desired state. The state is checked via the check_fn
         parameter, which should be a function taking a single argument
         representing a state tuple, and returning a boolean True if
-        the state matches the desired state.
+        the state matches the desired state. If throttle is True, the
+        call is delayed while the host is busy; the delay is recorded
+        in the returned status under ``throttled``.
         """
         status = self._status(host)
         if check_fn(status['state']):
             return status
-        with closing(url.urlopen('%s/%s' % (self.uri[host], self.control_name),
-                                 urlencode({'action': action}),
-                                 timeout=1)) as res:
-            # We don't actually want to do anything with the result,
-            # but we don't want to leave it just hanging around, so
-            # read and discard.
-            res.read()
+        if throttle:
+            delay = self._throttle(host)
+        self._send(host, action)
         if wait:
-            while not check_fn(status['state']):
-                sleep(.1)
-                status = self._status(host)
+            status = self._wait(host, check_fn)
+        if throttle:
+            status['throttled'] = delay
         return status
 
+    def _throttling(self):
+        """
+        Return True if starting the service should be delayed on busy
+        hosts.
+        """
+        return self.max_load is not None or self.max_memory is not None
+
+    def _busy(self, host):
+        """
+        Return True if the most recently seen metrics for the given
+        host exceed ``--max-load`` or ``--max-memory``.
+        """
+        metrics = self.host_metrics.get(host, {})
+        load = metrics.get('load', {}).get('avg01')
+        memory = metrics.get('memory', {}).get('percent')
+        return ((self.max_load is not None and load is not None and
+                 load > self.max_load) or
+                (self.max_memory is not None and memory is not None and
+                 memory > self.max_memory))
+
+    def _throttle(self, host):
+        """
+        Block while the given host is busy, for at most
+        ``--throttle-timeout`` seconds, and return the number of
+        seconds spent waiting.
+        """
+        begin = time()
+        while (self._busy(host) and
+               time() - begin < self.throttle_timeout):
+            sleep(self.throttle_interval)
+            self._fetch(host)
+        return time() - begin
+
+    def _by_load(self, hosts):
+        """
+        Return the given hosts sorted from least to most loaded, if
+        throttling is enabled. Hosts whose load is not known are placed
+        last. ``None`` means all hosts.
+        """
+        if not self._throttling():
+            return hosts
+        if hosts is None:
+            hosts = self.hosts
+        def fetch(host):
+            try:
+                self._fetch(host)
+            except UnresolvedHostError:
+                pass
+        pmap(fetch, hosts, workers=self.workers)
+
+        def load(host):
+            metrics = self.host_metrics.get(host, {})
+            return (metrics.get('load', {}).get('avg01', float('inf')),
+                    metrics.get('memory', {}).get('percent', float('inf')))
+        return sorted(hosts, key=load)
+
+    def _send(self, host, action):
+        """
+        Send the given Monit action for the service to the given host.
+        """
+        # Every action we send is idempotent - asking Monit to start
+        # a service which is already starting is harmless - so it is
+        # safe to let _request retry the call. We don't actually want
+        # to do anything with the result.
+        self.sent[host] = time()
+        self._request(host, self.control_name, urlencode({'action': action}))
+
+    def _wait(self, host, check_fn):
+        """
+        Block until check_fn returns True for the state of the service
+        on the given host, and return the status of the service. With a
+        collector, this completes as soon as Monit pushes the change;
+        a host which pushes its status is only polled if nothing
+        arrives for ``--collector-poll`` seconds. Other hosts, and every
+        host without a collector, are polled throughout. Raises
+        :py:class:`MonitAPIError` if the state has not changed after
+        ``--wait-timeout`` seconds.
+        """
+        deadline = time() + self.wait_timeout
+
+        def pushed(element):
+            return check_fn(self._parse_service(element)['state'])
+        while True:
+            poll = .1
+            if self.collector is not None:
+                # A host which has never pushed anything is polled as
+                # often as without a collector, but may still push the
+                # change we are waiting for.
+                if self.collector.pushes(self.addresses[host]):
+                    poll = self.collector_poll
+                element = self.collector.wait(
+                    self.addresses[host], self.control_name, pushed,
+                    min(poll, max(0, deadline - time())),
+                    since=self.sent.get(host))
+                if element is not None:
+                    return self._record(host, self._parse_service(element))
+            status = self._status(host, pushed=False)
+            if check_fn(status['state']):
+                return status
+            if time() >= deadline:
+                raise MonitAPIError('%s did not reach the desired state on '
+                                    '%s within %s seconds' %
+                                    (self.control_name, host,
+                                     self.wait_timeout))
+            if self.collector is None:
+                sleep(poll)
+
     def _parse_monit_status(self, element):
         """
         Given an XML element representing a service, extract the
@@ -130,39 +631,96 @@ class Monit(Service):
         not. The value None for either component is to indicate that
         it is either unknown or does not make sense for the service.
         """
-        # The 'monitor' element tells us whether Monit is actively
+        return self._monit_state(int(element.find('monitor').text),
+                                 int(element.find('status').text))
+
+    def _monit_state(self, monitor, status):
+        """
+        Given the values of the 'monitor' and 'status' fields Monit
+        reports for a service, return the state tuple for the
+        service.
+        """
+        # The 'monitor' field tells us whether Monit is actively
         # controlling the service or not. A 0 means Monit is not
         # controlling the service. Sadly, when the service is stopped
-        # by Monit, this element says Monit is *not* controlling the
+        # by Monit, this field says Monit is *not* controlling the
         # service, even though it is. So, potentially, the service
         # could be running, but Monit has been told not to control
         # it. However, usually that is not the case and we're taking a
         # shortcut here by assuming it isn't.
-        monitor = int(element.find('monitor').text)
         if monitor == 0:
             return (False, False)
-        # The 'status' element tells us whether the service is running
+        # The 'status' field tells us whether the service is running
         # or not. Any value other than 0 means the service is not
         # running. More specific info is available via the web API,
         # but lacking any documentation on what it means, that
         # information is useless and we don't bother looking at it.
-        status = int(element.find('status').text)
         if status == 0:
             return (True, True)
         else:
             return (True, False)
 
-    def _status(self, host):
+    def _parse_monit_system(self, element):
+        """
+        Given an XML element representing the host itself, extract
+        the resource usage information and return it as a dict of
+        dicts, such as ``{'load': {'avg01': 0.5, ...}, 'cpu': {'user':
+        10.2, ...}, 'memory': {'percent': 42.0, ...}}``.
+        """
+        metrics = {}
+        system = element.find('system')
+        if system is None:
+            return metrics
+        for group in system:
+            values = {}
+            for child in group:
+                try:
+                    values[child.tag] = float(child.text)
+                except (TypeError, ValueError):
+                    pass
+            metrics[group.tag] = values
+        return metrics
+
+    def _fetch(self, host):
         """
-        Returns the status of the service as a dict.
+        Fetch the Monit status document from the given host and return
+        it as an XML element tree. The host's resource usage is
+        recorded in ``self.host_metrics`` as a side effect.
         """
-        print '%s/_status?format=xml' % self.uri[host]
-        with closing(url.urlopen('%s/_status?format=xml' % self.uri[host],
-                                 timeout=1)) as res:
-            data = res.read()
+        data = self._request(host, '_status?format=xml')
         if not data:
             raise MonitAPIError('No content from server')
         tree = ElementTree.fromstring(data)
+        for element in tree.getiterator('service'):
+            if int(element.get('type')) == 5:
+                self.host_metrics[host] = self._parse_monit_system(element)
+        return tree
+
+    def _pushed(self, host):
+        """
+        Return the element for the service most recently pushed by the
+        given host to the collector, or None if there is no collector
+        or no sufficiently recent status. Status pushed before the last
+        action was sent to the host is never used, since it no longer
+        describes the service. The host's resource usage is recorded in
+        ``self.host_metrics`` as a side effect.
+        """
+        if self.collector is None:
+            return None
+        element = self.collector.latest(self.addresses[host],
+                                        self.control_name,
+                                        max_age=self.collector_max_age,
+                                        since=self.sent.get(host))
+        system = self.collector.system(self.addresses[host])
+        if element is not None and system is not None:
+            self.host_metrics[host] = self._parse_monit_system(system)
+        return element
+
+    def _find_service(self, tree):
+        """
+        Given a Monit status document, return the element for the
+        service.
+        """
         # Grab the relevant 'service' element. We're interested in
         # 'service' elements with a 'type' attribute == 3 because
         # these are the actual services. Monit represents the host
@@ -177,8 +735,14 @@ class Monit(Service):
         elif len(services) > 1:
             raise MonitAPIError('Multiple service entries found for %s' %
                                 self.control_name)
+        return services[0]
+
+    def _parse_service(self, service):
+        """
+        Given the XML element for the service, return the status of the
+        service as a dict.
+        """
         status = {}
-        service = services[0]
         status['state'] = self._parse_monit_status(service)
         pid = service.find('pid')
         if pid is not None:
@@ -188,18 +752,60 @@ class Monit(Service):
             status['uptime'] = int(uptime.text)
         return status
 
-    def status(self):
+    def _status(self, host, pushed=True):
+        """
+        Returns the status of the service as a dict. If ``pushed`` is
+        False, the status is always fetched from the host, even if it
+        has recently pushed its status to the collector.
+        """
+        element = None
+        if pushed:
+            element = self._pushed(host)
+        if element is None:
+            element = self._find_service(self._fetch(host))
+        return self._record(host, self._parse_service(element))
+
+    def _record(self, host, status):
+        """
+        Record the status of the service on the given host in the
+        history store, if the service has one, and return the status.
+        """
+        if self.history is not None:
+            self.history.append(self.control_name, host, status)
+        return status
+
+    def status(self, hosts=None):
         """
         Returns the status of the service on each host as a dict whose
         keys are the host names and values are the status dictionary
         for the service on that host.
+
+        ``hosts``
+          If given, a list of the hosts to check, instead of all of
+          them.
         """
-        status = {}
-        for host in self.uri.keys():
-            status[host] = self._status(host)
-        return status
+        return self._each_host(self._status, hosts=hosts)
+
+    def metrics(self, hosts=None):
+        """
+        Returns the resource usage reported by Monit for each host as
+        a dict whose keys are the host names and values are dicts of
+        metrics, grouped as Monit groups them: ``load`` (``avg01``,
+        ``avg05``, ``avg15``), ``cpu`` (``user``, ``system``,
+        ``wait``), ``memory`` and ``swap`` (``percent``,
+        ``kilobyte``). Hosts whose names could not be resolved are
+        reported with an ``error`` key instead.
 
-    def enable(self, wait=False):
+        ``hosts``
+          If given, a list of the hosts to check, instead of all of
+          them.
+        """
+        def fetch(host):
+            self._fetch(host)
+            return dict(self.host_metrics.get(host, {}))
+        return self._each_host(fetch, hosts=hosts, status=False)
+
+    def enable(self, wait=False, hosts=None):
         """
         If monitoring of the service is already enabled, this is a
         no-op. If monitoring is not enabled, run any ``pre-enable``
@@ -212,15 +818,16 @@ class Monit(Service):
         ``wait``
           If ``True``, block until the state change is confirmed in
           the API.
+        ``hosts``
+          If given, a list of the hosts on which to act, instead of
+          all of them.
         """
-        status = {}
-        for host in self.uri.keys():
-            status[host] = self._api_call(host, 'monitor',
-                                          lambda state: state[0] is True,
-                                          wait=wait)
-        return status
+        call, check = self.ACTIONS['enable']
+        return self._each_host(
+            lambda host: self._api_call(host, call, check, wait=wait),
+            hosts=hosts)
 
-    def disable(self, wait=False):
+    def disable(self, wait=False, hosts=None):
         """
         If monitoring of the service is already disabled, this is a
         no-op. If monitoring is not disabled, run any ``pre-disable``
@@ -233,13 +840,14 @@ class Monit(Service):
         ``wait``
           If ``True``, block until the state change is confirmed in
           the API.
+        ``hosts``
+          If given, a list of the hosts on which to act, instead of
+          all of them.
         """
-        status = {}
-        for host in self.uri.keys():
-            status[host] = self._api_call(host, 'unmonitor',
-                                          lambda state: state[0] is False,
-                                          wait=wait)
-        return status
+        call, check = self.ACTIONS['disable']
+        return self._each_host(
+            lambda host: self._api_call(host, call, check, wait=wait),
+            hosts=hosts)
 
     def reload(self):
         """
@@ -247,7 +855,7 @@ class Monit(Service):
         """
         raise MonitAPIError('Reload is not supported by Monit.')
 
-    def start(self, wait=False):
+    def start(self, wait=False, hosts=None):
         """
         If the service is already running, this is a no-op. If the
         service is not running, run any ``pre-start hooks``. If these
@@ -260,15 +868,17 @@ class Monit(Service):
         ``wait``
           If ``True``, block until the state change is confirmed in
           the API.
+        ``hosts``
+          If given, a list of the hosts on which to act, instead of
+          all of them.
         """
-        status = {}
-        for host in self.uri.keys():
-            status[host] = self._api_call(host, 'start',
-                                          lambda state: state[1] is True,
-                                          wait=wait)
-        return status
+        call, check = self.ACTIONS['start']
+        return self._each_host(
+            lambda host: self._api_call(host, call, check, wait=wait,
+                                        throttle=self._throttling()),
+            hosts=self._by_load(hosts))
 
-    def stop(self, wait=False):
+    def stop(self, wait=False, hosts=None):
         """
         If the service is already stopped, this is a no-op. If the
         service is running, run any ``pre-stop hooks``. If these hooks
@@ -280,10 +890,168 @@ class Monit(Service):
         ``wait``
           If ``True``, block until the state change is confirmed in
           the API.
+        ``hosts``
+          If given, a list of the hosts on which to act, instead of
+          all of them.
         """
-        status = {}
-        for host in self.uri.keys():
-            status[host] = self._api_call(host, 'stop',
-                                          lambda state: state[1] is False,
-                                          wait=wait)
+        call, check = self.ACTIONS['stop']
+        return self._each_host(
+            lambda host: self._api_call(host, call, check, wait=wait),
+            hosts=hosts)
+
+    def restart(self, wait=False, hosts=None):
+        """
+        Call :py:func:`stop() <piro.service.monit.Monit.stop>` on the
+        service, waiting for the service to stop, then call
+        :py:func:`start() <piro.service.monit.Monit.start>` on the
+        service. Finally return the result of calling
+        :py:func:`status() <piro.service.monit.Monit.status>` on the
+        service. The restart action does not have any hooks of its
+        own - add hooks to :py:func:`start()
+        <piro.service.monit.Monit.start>` and/or :py:func:`stop()
+        <piro.service.monit.Monit.stop>` instead.
+
+        ``wait``
+          If ``True``, block until the service is confirmed to be
+          running again in the API.
+        ``hosts``
+          If given, a list of the hosts on which to act, instead of
+          all of them.
+
+        If ``--max-load`` or ``--max-memory`` is given, each host is
+        restarted on its own, least loaded first, and the service is
+        only stopped on a busy host once it is below both thresholds,
+        so it is never left stopped while waiting for the host to
+        calm down. The ``pre-stop`` and ``pre-start`` hooks run before
+        any host is restarted, and the ``post-stop`` and
+        ``post-start`` hooks after every host has been.
+        """
+        if self._throttling():
+            return self._restart_throttled(wait, hosts)
+        # Without waiting for the stop, start would find the service
+        # still running and do nothing.
+        self.stop(wait=True, hosts=hosts)
+        self.start(wait=wait, hosts=hosts)
+        return self.status(hosts=hosts)
+
+    def _restart_throttled(self, wait, hosts):
+        """
+        Restart the service on each host in turn, waiting for a busy
+        host to calm down before stopping the service on it.
+        """
+        stop_call, stop_check = self.ACTIONS['stop']
+        start_call, start_check = self.ACTIONS['start']
+
+        def restart(host):
+            delay = self._throttle(host)
+            self._api_call(host, stop_call, stop_check, wait=True)
+            status = self._api_call(host, start_call, start_check, wait=wait)
+            status['throttled'] = delay
+            return status
+        self._run_hooks('pre_stop')
+        self._run_hooks('pre_start')
+        result = self._each_host(restart, hosts=self._by_load(hosts))
+        self._run_hooks('post_stop')
+        self._run_hooks('post_start')
+        return result
+
+    def plan(self, action):
+        """
+        Work out which hosts need the Monit API call for ``action``
+        (one of the keys of ``ACTIONS``) without making any
+        changes. The status of the service is fetched from every host
+        concurrently. Returns a plan as a dict with the following
+        keys:
+
+        ``service``, ``control_name``, ``action``
+          What the plan applies to.
+        ``hosts``
+          The hosts on which the Monit action must be performed.
+        ``unresolved``
+          The hosts which could not be planned for because their
+          names could not be resolved.
+        ``status``
+          The status of the service on every host when the plan was
+          made.
+        ``estimate``
+          Estimated time, in seconds, to carry out the plan, based on
+          the response times observed while making it.
+
+        The plan can be carried out with :py:func:`execute_plan()
+        <piro.service.monit.Monit.execute_plan>`.
+        """
+        if action not in self.ACTIONS:
+            raise MonitAPIError('Action %s can not be planned' % action)
+        check = self.ACTIONS[action][1]
+
+        def timed_status(host):
+            begin = time()
+            try:
+                status = self._status(host)
+            except UnresolvedHostError, error:
+                status = {'state': (None, None), 'error': str(error)}
+            return status, time() - begin
+
+        hosts = self.hosts
+        results = dict(zip(hosts, pmap(timed_status, hosts,
+                                       workers=self.workers)))
+        self.latency.save()
+        changed = sorted(host for host, (status, elapsed) in results.items()
+                         if 'error' not in status and
+                         not check(status['state']))
+        unresolved = sorted(host for host, (status, elapsed) in results.items()
+                            if 'error' in status)
+        elapsed = [results[host][1] for host in changed]
+        if elapsed:
+            # One request per changed host, spread over the workers.
+            estimate = max(max(elapsed), sum(elapsed) / self.workers)
+        else:
+            estimate = 0.0
+        return {'service': self.name,
+                'control_name': self.control_name,
+                'action': action,
+                'hosts': changed,
+                'unresolved': unresolved,
+                'status': dict((host, status)
+                               for host, (status, elapsed) in results.items()),
+                'estimate': estimate}
+
+    def execute_plan(self, plan, wait=False):
+        """
+        Carry out a plan made by :py:func:`plan()
+        <piro.service.monit.Monit.plan>`, performing the Monit API
+        call on exactly the hosts listed in the plan without checking
+        their status again. Any hooks for the planned action are run
+        before and after the calls. Returns the status of the service
+        on each host in the plan; for hosts which were changed, the
+        status is the one recorded in the plan with an ``action`` key
+        added, unless ``wait`` is True.
+
+        ``wait``
+          If ``True``, block until the state change is confirmed in
+          the API on every changed host.
+        """
+        if plan['control_name'] != self.control_name:
+            raise MonitAPIError('Plan is for service %s, not %s' %
+                                (plan['control_name'], self.control_name))
+        unknown = set(plan['hosts']) - set(self.hosts)
+        if unknown:
+            raise MonitAPIError('Plan includes unknown hosts: %s' %
+                                ', '.join(sorted(unknown)))
+        action = plan['action']
+        call, check = self.ACTIONS[action]
+        self._run_hooks('pre_%s' % action)
+
+        def run(host):
+            self._send(host, call)
+            if wait:
+                return self._wait(host, check)
+            status = dict(plan['status'][host])
+            status['action'] = call
+            return status
+
+        status = dict(plan['status'])
+        status.update(zip(plan['hosts'],
+                          pmap(run, plan['hosts'], workers=self.workers)))
+        self._run_hooks('post_%s' % action)
         return status
@@ -0,0 +1,375 @@
+"""
+The process module provides a built-in service control class for
+services running on the local host which are not supervised by
+Monit. The state of the service is found by reading ``/proc``
+directly, and the service is started and stopped by running
+configured commands, such as an init script.
+
+A service's process is identified either by a pidfile, or by a regular
+expression matched against the command lines of all running
+processes other than piro itself, the processes which started it and
+any other running copies of piro.
+The status of many services can be found with a single pass over
+``/proc`` using :py:meth:`Process.status_many()
+<piro.service.process.Process.status_many>`.
+"""
+import os
+import re
+import shlex
+import subprocess
+from time import sleep, time
+
+from piro.service import Service
+
+
+class ProcessError(StandardError):
+    """
+    Error raised when a service's control command fails, or the
+    service does not reach the desired state in time.
+    """
+    pass
+
+
+def _read(path):
+    """
+    Return the contents of the file at ``path``, or None if it can
+    not be read (for example because the process has exited).
+    """
+    try:
+        with open(path) as handle:
+            return handle.read()
+    except (IOError, OSError):
+        return None
+
+
+def _stat(pid, proc='/proc'):
+    """
+    Return the fields of ``/proc/PID/stat`` following the command
+    name, or None if the process does not exist or is a zombie. The
+    first of these fields is field 3 of the file, the process state.
+    """
+    stat = _read(os.path.join(proc, str(pid), 'stat'))
+    if stat is None:
+        return None
+    # The command name in field 2 may contain spaces, so count fields
+    # from the closing parenthesis.
+    fields = stat[stat.rindex(')') + 2:].split()
+    if fields[0] in ('Z', 'X'):
+        return None
+    return fields
+
+
+def _ancestors(proc='/proc'):
+    """
+    Return the pids of this process and all of its ancestors. Their
+    command lines often contain the name of the service being
+    controlled - ``sudo piro start myservice``, or a shell running
+    piro - but they are never the service itself.
+    """
+    pids = set()
+    pid = os.getpid()
+    while pid > 0 and pid not in pids:
+        pids.add(pid)
+        fields = _stat(pid, proc=proc)
+        if fields is None:
+            break
+        pid = int(fields[1])
+    return pids
+
+
+_WRAPPER = re.compile(r'^(sudo|env|nice|nohup|python[0-9.]*)$')
+
+
+def _is_piro(argv):
+    """
+    Return True if the command line ``argv`` (a list of arguments) runs
+    piro, directly or through an interpreter or a wrapper such as
+    ``sudo``: ``piro stop memcached``, ``python /usr/bin/piro ...`` or
+    ``sudo python -m piro.cli ...``. Other copies of piro controlling
+    the same service have its name on their command lines, but they
+    are never the service itself.
+    """
+    for index, word in enumerate(argv):
+        if word == '-m':
+            return (index + 1 < len(argv) and
+                    argv[index + 1].split('.')[0] == 'piro')
+        word = os.path.basename(word)
+        if word == 'piro':
+            return True
+        # Skip the wrapper, its options and environment assignments
+        # until we reach the command being run.
+        if not (_WRAPPER.match(word) or word.startswith('-') or
+                '=' in word):
+            return False
+    return False
+
+
+def scan(processes, proc='/proc'):
+    """
+    Find the running processes for several services in a single pass
+    over ``proc``. ``processes`` is a list of :py:class:`Process`
+    instances. Returns a dict whose keys are the instances and values
+    are the status dicts for those services.
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+    uptime = float(_read(os.path.join(proc, 'uptime')).split()[0])
+
+    def arguments(pid):
+        line = _read(os.path.join(proc, str(pid), 'cmdline')) or ''
+        return line.rstrip('\0').split('\0')
+
+    def cmdline(pid):
+        return ' '.join(arguments(pid))
+
+    candidates = dict((process, []) for process in processes)
+    patterns = []
+    for process in processes:
+        if process.pidfile is None:
+            patterns.append(process)
+            continue
+        pid = _read(process.pidfile)
+        if pid is None or not pid.strip().isdigit():
+            continue
+        # With a pattern as well, make sure the pid has not been
+        # reused by some other process since the pidfile was written.
+        if (process.pattern is None or
+            process.pattern.search(cmdline(int(pid)))):
+            candidates[process].append(int(pid))
+    # Command lines are only read if some service needs them, and
+    # each is read at most once however many services are matched.
+    if patterns:
+        ignore = _ancestors(proc=proc)
+        for entry in os.listdir(proc):
+            if not entry.isdigit() or int(entry) in ignore:
+                continue
+            argv = arguments(entry)
+            if _is_piro(argv):
+                continue
+            line = ' '.join(argv)
+            for process in patterns:
+                if line and process.pattern.search(line):
+                    candidates[process].append(int(entry))
+    status = {}
+    for process, pids in candidates.items():
+        started = []
+        for pid in pids:
+            fields = _stat(pid, proc=proc)
+            if fields is not None:
+                started.append((int(fields[19]), pid))
+        if started:
+            # Prefer the oldest process: the parent of any workers.
+            begin, pid = min(started)
+            status[process] = {'state': (None, True),
+                               'pid': pid,
+                               'uptime': int(uptime - begin / ticks)}
+        else:
+            status[process] = {'state': (None, False)}
+    return status
+
+
+class Process(Service):
+    """
+    Controls a service running on the local host.
+    """
+
+    @classmethod
+    def _init_parser(cls):
+        parser = Service._init_parser()
+        parser.add_argument('--pidfile', default=None,
+                            help='File containing the pid of the '
+                            'service\'s main process.')
+        parser.add_argument('--pattern', default=None,
+                            help='Regular expression matching the command '
+                            'line of the service\'s main process.')
+        parser.add_argument('--start-command', default=None,
+                            help='Command which starts the service.')
+        parser.add_argument('--stop-command', default=None,
+                            help='Command which stops the service.')
+        parser.add_argument('--reload-command', default=None,
+                            help='Command which reloads the service\'s '
+                            'configuration.')
+        parser.add_argument('--wait-timeout', type=float, default=30,
+                            help='Seconds to wait for the service to start '
+                            'or stop.')
+        parser.add_argument('--proc', default='/proc',
+                            help='Where the proc filesystem is mounted.')
+        return parser
+
+    def __init__(self, name, control_name=None, svc_args=[]):
+        """
+        Initialize a service running on the local host.
+
+        ``name``
+          Human-friendly name for the service.
+        ``control_name``
+          Name that the underlying service control system uses to
+          identify the service.
+        ``svc_args``
+          Command-line arguments specific to this service, in the
+          format expected by argparse. Local services require either
+          ``--pidfile`` or ``--pattern``, and use the following
+          options:
+
+          ``--pidfile``
+            File containing the pid of the service's main process.
+          ``--pattern``
+            Regular expression matching the command line of the
+            service's main process. Running copies of piro, and the
+            processes which started this one, are never matched. If
+            there are several matching processes, the oldest is used.
+            If ``--pidfile`` is also given, the pattern is only used
+            to check that the pid in the pidfile belongs to the
+            service.
+          ``--start-command``, ``--stop-command``, ``--reload-command``
+            Commands which start, stop and reload the service. The
+            corresponding action is not available if no command is
+            given.
+          ``--wait-timeout``
+            Seconds to wait for the service to start or stop.
+          ``--proc``
+            Where the proc filesystem is mounted.
+        """
+        Service.__init__(self, name, control_name=control_name)
+        args = self._init_parser().parse_known_args(svc_args)[0]
+        if args.pidfile is None and args.pattern is None:
+            raise ProcessError('Service %s needs a --pidfile or --pattern' %
+                               self.name)
+        self.pidfile = args.pidfile
+        self.pattern = None
+        if args.pattern is not None:
+            self.pattern = re.compile(args.pattern)
+        self.commands = {'start': args.start_command,
+                         'stop': args.stop_command,
+                         'reload': args.reload_command}
+        self.wait_timeout = args.wait_timeout
+        self.proc = args.proc
+
+    @classmethod
+    def status_many(cls, processes):
+        """
+        Return the status of several local services, found in a single
+        pass over ``/proc``, as a dict whose keys are the service names
+        and values are their status dicts.
+        """
+        if not processes:
+            return {}
+        found = scan(processes, proc=processes[0].proc)
+        return dict((process.name, found[process]) for process in processes)
+
+    def _run(self, action):
+        """
+        Run the command configured for the given action, blocking until
+        it exits.
+        """
+        command = self.commands[action]
+        if command is None:
+            raise NotImplementedError('"%s" method not available for '
+                                      'service %s' % (action, self.name))
+        code = subprocess.call(shlex.split(command))
+        if code != 0:
+            raise ProcessError('%s of %s failed with exit code %d' %
+                               (action, self.name, code))
+
+    def _probe(self, pid):
+        """
+        Cheaply check whether the service is running, given the pid it
+        was last seen with, without scanning ``/proc``.
+        """
+        if pid is None and self.pidfile is not None:
+            pid = _read(self.pidfile)
+            if pid is None or not pid.strip().isdigit():
+                return False
+        if pid is None:
+            return None
+        return _stat(int(pid), proc=self.proc) is not None
+
+    def _wait(self, running, pid=None):
+        """
+        Block until the service is running (if ``running`` is True) or
+        stopped, and return its status. Raises
+        :py:class:`ProcessError` after ``--wait-timeout`` seconds.
+        """
+        deadline = time() + self.wait_timeout
+        delay = 0.01
+        while True:
+            # Probing a single pid or pidfile is much cheaper than a
+            # full scan, so only scan when the probe says we're done
+            # or can't tell.
+            if self._probe(pid) in (running, None):
+                status = self.status()
+                if status['state'][1] is running:
+                    return status
+            if time() >= deadline:
+                raise ProcessError('%s did not %s within %s seconds' %
+                                   (self.name,
+                                    running and 'start' or 'stop',
+                                    self.wait_timeout))
+            sleep(delay)
+            delay = min(delay * 2, 0.5)
+
+    def status(self):
+        """
+        Return the status of the service as a dict with the keys
+        ``state``, ``pid`` and ``uptime``. The enable component of the
+        state is always ``None``, since local services are not
+        monitored.
+        """
+        return scan([self], proc=self.proc)[self]
+
+    def reload(self):
+        """
+        Run the ``--reload-command``, then return the result of calling
+        :py:func:`status() <piro.service.process.Process.status>` on
+        the service.
+        """
+        self._run('reload')
+        return self.status()
+
+    def start(self, wait=False):
+        """
+        If the service is already running, this is a no-op. Otherwise,
+        run the ``--start-command``. Finally, return the result of
+        calling :py:func:`status()
+        <piro.service.process.Process.status>` on the service.
+
+        ``wait``
+          If ``True``, block until the service's process appears.
+        """
+        status = self.status()
+        if status['state'][1]:
+            return status
+        self._run('start')
+        if wait:
+            return self._wait(True)
+        return self.status()
+
+    def stop(self, wait=False):
+        """
+        If the service is already stopped, this is a no-op. Otherwise,
+        run the ``--stop-command``. Finally, return the result of
+        calling :py:func:`status()
+        <piro.service.process.Process.status>` on the service.
+
+        ``wait``
+          If ``True``, block until the service's process exits.
+        """
+        status = self.status()
+        if not status['state'][1]:
+            return status
+        self._run('stop')
+        if wait:
+            return self._wait(False, status['pid'])
+        return self.status()
+
+    def restart(self):
+        """
+        Call :py:func:`stop() <piro.service.process.Process.stop>` on
+        the service, waiting for its process to exit, then call
+        :py:func:`start() <piro.service.process.Process.start>` on the
+        service. Finally return the result of calling
+        :py:func:`status() <piro.service.process.Process.status>` on
+        the service.
+        """
+        self.stop(wait=True)
+        self.start(wait=True)
+        return self.status()
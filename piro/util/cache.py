@@ -0,0 +1,40 @@
+"""
+JSON cache files shared between runs of piro.
+
+Several parts of piro remember what they learn about hosts - response
+times, resolved addresses - in small JSON files, so that later runs
+can start from what earlier runs found out. Many copies of piro may
+read and write the same file at once, so :py:func:`save` never
+leaves a partly written file behind.
+"""
+import json
+import os
+import tempfile
+
+
+def load(path, default):
+    """
+    Return the data kept in the JSON file at ``path``, or ``default``
+    if there is no such file or it can not be read.
+    """
+    try:
+        with open(path) as cache:
+            return json.load(cache)
+    except (IOError, ValueError):
+        return default
+
+
+def save(path, data):
+    """
+    Write ``data`` to the JSON file at ``path``, creating its directory
+    if necessary.
+    """
+    directory = os.path.dirname(path) or '.'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Write to a temporary file and rename it into place, so that
+    # concurrent runs never see a partly written cache.
+    handle, name = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'w') as cache:
+        json.dump(data, cache)
+    os.rename(name, path)
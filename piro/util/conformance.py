@@ -0,0 +1,538 @@
+"""
+A conformance and performance harness for service controllers.
+
+Plugins in ``piro.plugins`` implement the :py:class:`Service API
+<piro.service.Service>`, but nothing checks that they do so correctly,
+or quickly enough to control a large fleet. A
+:py:class:`ConformanceHarness` exercises every action of a service
+controller, with hooks attached, against a :py:class:`SimulatedBackend`
+and reports:
+
+* violations of the Service API contract, such as a status dict with
+  no ``state`` tuple, an action which does not take effect, an action
+  which is not a no-op when the service is already in the desired
+  state, or hooks which are not run;
+* actions the controller does not support;
+* the latency of each action, and the number of requests it makes to
+  each host.
+
+The simulated backend serves the Monit HTTP API, so controllers built
+on the :py:class:`Monit class <piro.service.monit.Monit>` can be
+tested as they are. Each simulated host listens on its own loopback
+address (``127.0.0.1``, ``127.0.0.2``, ...), which requires an
+operating system, such as Linux, that routes all of ``127.0.0.0/8`` to
+the loopback interface. Some or all of the hosts can also report to a
+simulated M/Monit server, serving the API the :py:class:`MMonit class
+<piro.service.mmonit.MMonit>` uses, on a port of its own. Controllers
+which talk to something else are connected to the backend by the
+``factory`` given to the harness; the backend's
+:py:meth:`SimulatedBackend.status` and :py:meth:`SimulatedBackend.act`
+methods can be called directly.
+
+From the command line, ``piro conform SERVICE`` runs the harness
+against the class configured for ``SERVICE`` in ``SERVICE_MAP``.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler
+import json
+import random
+from threading import Lock
+from time import sleep, time
+import urlparse
+from xml.sax.saxutils import escape
+
+from piro.service import HookError, STATE_CHECKS
+from piro.util.server import ThreadedHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """
+    Serves the Monit HTTP API for one simulated host.
+    """
+
+    def _respond(self, code, body=''):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        """
+        Simulate network and server latency, and return False if this
+        request should fail.
+        """
+        backend = self.server.backend
+        backend.request(self.server.host)
+        sleep(max(0, random.gauss(backend.latency, backend.jitter)))
+        return random.random() >= backend.failure_rate
+
+    def do_GET(self):
+        if not self._delay():
+            return self._respond(503)
+        if not self.path.startswith('/_status'):
+            return self._respond(404)
+        self._respond(200, self.server.backend.document(self.server.host))
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self._delay():
+            return self._respond(503)
+        name = urlparse.unquote(self.path.lstrip('/'))
+        action = urlparse.parse_qs(data).get('action', [None])[0]
+        try:
+            self.server.backend.act(self.server.host, name, action)
+        except KeyError:
+            return self._respond(404)
+        self._respond(200)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _MMonitHandler(_Handler):
+    """
+    Serves the M/Monit API for the simulated hosts which report to it.
+    """
+
+    def do_GET(self):
+        if not self._delay():
+            return self._respond(503)
+        path, _, query = self.path.partition('?')
+        if path != '/status/services/list':
+            return self._respond(404)
+        query = urlparse.parse_qs(query)
+        page = self.server.backend.records(
+            query.get('service', [None])[0],
+            int(query.get('startindex', [0])[0]),
+            int(query.get('results', [500])[0]))
+        self._respond(200, json.dumps(page))
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self._delay():
+            return self._respond(503)
+        if self.path != '/admin/hosts/action':
+            return self._respond(404)
+        data = urlparse.parse_qs(data)
+        backend = self.server.backend
+        try:
+            hostid = int(data['id'][0])
+            if not 0 < hostid <= backend.mmonit_hosts:
+                raise KeyError(hostid)
+            backend.act(backend.hosts[hostid - 1], data['service'][0],
+                        data['action'][0])
+        except (KeyError, ValueError):
+            return self._respond(404)
+        self._respond(200)
+
+
+class SimulatedBackend(object):
+    """
+    A simulated fleet of hosts running Monit.
+    """
+
+    def __init__(self, hosts=10, services=('simulated',), latency=0.005,
+                 jitter=0.001, failure_rate=0.0, action_delay=0.05,
+                 mmonit_hosts=0):
+        """
+        ``hosts``
+          Number of hosts to simulate.
+        ``services``
+          Names of the services running on every host.
+        ``latency``, ``jitter``
+          Mean and standard deviation, in seconds, of the time taken
+          to answer each request.
+        ``failure_rate``
+          Fraction of requests which fail with HTTP status 503.
+        ``action_delay``
+          Seconds an action takes to take effect.
+        ``mmonit_hosts``
+          Number of hosts, starting with the first, which report to a
+          simulated M/Monit server. The server is only started if this
+          is more than zero.
+        """
+        self.hosts = ['127.0.%d.%d' % (index // 250, index % 250 + 1)
+                      for index in range(hosts)]
+        self.services = list(services)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.action_delay = action_delay
+        self.mmonit_hosts = min(mmonit_hosts, hosts)
+        self.port = None
+        self.mmonit_url = None
+        self.requests = dict((host, 0) for host in self.hosts)
+        self.mmonit_requests = 0
+        self.actions = 0
+        self.servers = []
+        self._lock = Lock()
+        self._next_pid = 1000
+        self.state = {}
+        for host in self.hosts:
+            for name in self.services:
+                self.state[(host, name)] = {'monitor': 1,
+                                            'status': 0,
+                                            'pid': self._pid(),
+                                            'started': time(),
+                                            'pending': None}
+
+    def _pid(self):
+        self._next_pid += 1
+        return self._next_pid
+
+    def start(self):
+        """
+        Start serving the Monit HTTP API on every simulated host. All
+        hosts listen on the same port, which is stored in ``port``. If
+        any hosts report to M/Monit, also start serving the M/Monit API
+        on the first loopback address, at the URL stored in
+        ``mmonit_url``.
+        """
+        for host in self.hosts:
+            server = ThreadedHTTPServer((host, self.port or 0), _Handler)
+            server.backend = self
+            server.host = host
+            self.port = server.server_address[1]
+            server.start()
+            self.servers.append(server)
+        if self.mmonit_hosts:
+            server = ThreadedHTTPServer(('127.0.0.1', 0), _MMonitHandler)
+            server.backend = self
+            server.host = None
+            self.mmonit_url = 'http://127.0.0.1:%d' % server.server_address[1]
+            server.start()
+            self.servers.append(server)
+
+    def stop(self):
+        """
+        Stop serving the Monit HTTP API, and the M/Monit API.
+        """
+        for server in self.servers:
+            server.stop()
+        self.servers = []
+
+    def request(self, host):
+        """
+        Count a request made to ``host``, or to the M/Monit server if
+        ``host`` is None.
+        """
+        with self._lock:
+            if host is None:
+                self.mmonit_requests += 1
+            else:
+                self.requests[host] += 1
+
+    def total_requests(self):
+        """
+        Return the number of requests made so far, to the hosts and to
+        the M/Monit server.
+        """
+        with self._lock:
+            return sum(self.requests.values()) + self.mmonit_requests
+
+    def _settle(self, state):
+        """
+        Apply a pending action to ``state`` if it has taken effect.
+        """
+        if state['pending'] is not None and time() >= state['pending'][0]:
+            action = state['pending'][1]
+            state['pending'] = None
+            if action in ('start', 'restart'):
+                state.update(monitor=1, status=0, pid=self._pid(),
+                             started=time())
+            elif action == 'stop':
+                state.update(monitor=0, status=512)
+            elif action == 'monitor':
+                state['monitor'] = 1
+            elif action == 'unmonitor':
+                state['monitor'] = 0
+
+    def status(self, host, name):
+        """
+        Return the true state of the service ``name`` on ``host`` as a
+        tuple of the form ``(enabled, running, pid)``.
+        """
+        with self._lock:
+            state = self.state[(host, name)]
+            self._settle(state)
+            running = state['status'] == 0 and state['monitor'] != 0
+            return (state['monitor'] != 0, running, state['pid'])
+
+    def act(self, host, name, action):
+        """
+        Perform a Monit action (``start``, ``stop``, ``restart``,
+        ``monitor`` or ``unmonitor``) on the service ``name`` on
+        ``host``. The action takes effect after ``action_delay``
+        seconds. Raises ``KeyError`` for an unknown service.
+        """
+        with self._lock:
+            state = self.state[(host, name)]
+            self._settle(state)
+            self.actions += 1
+            state['pending'] = (time() + self.action_delay, action)
+
+    def records(self, name, start, count):
+        """
+        Return a page of the M/Monit status list for the service
+        ``name``, with up to ``count`` records starting at index
+        ``start``, as a dict of the form ``{'totalRecords': T,
+        'records': [...]}``.
+        """
+        records = []
+        with self._lock:
+            if name in self.services:
+                for index, host in enumerate(
+                        self.hosts[:self.mmonit_hosts]):
+                    state = self.state[(host, name)]
+                    self._settle(state)
+                    records.append({'hostid': index + 1,
+                                    'hostname': host,
+                                    'monitor': state['monitor'],
+                                    'status': state['status'],
+                                    'pid': state['pid'],
+                                    'uptime': int(time() - state['started'])})
+        return {'totalRecords': len(records),
+                'records': records[start:start + count]}
+
+    def document(self, host):
+        """
+        Return the Monit status document for ``host``.
+        """
+        services = []
+        with self._lock:
+            for name in self.services:
+                state = self.state[(host, name)]
+                self._settle(state)
+                services.append(
+                    '<service type="3"><name>%s</name>'
+                    '<monitor>%d</monitor><status>%d</status>'
+                    '<pid>%d</pid><uptime>%d</uptime></service>' %
+                    (escape(name), state['monitor'], state['status'],
+                     state['pid'], time() - state['started']))
+        return ('<?xml version="1.0" encoding="ISO-8859-1"?><monit>'
+                '<server><localhostname>%s</localhostname></server>'
+                '<service type="5"><name>%s</name><system>'
+                '<load><avg01>0.10</avg01><avg05>0.10</avg05>'
+                '<avg15>0.10</avg15></load>'
+                '<memory><percent>10.0</percent></memory>'
+                '</system></service>%s</monit>' %
+                (host, host, ''.join(services)))
+
+
+class ConformanceHarness(object):
+    """
+    Checks a service controller against the Service API contract and
+    measures its performance.
+    """
+
+    ACTIONS = ['status', 'disable', 'enable', 'stop', 'start', 'restart']
+    """
+    Actions exercised by the harness, in the order they are run.
+    """
+
+    STATES = {'enable': 'enabled', 'disable': 'disabled',
+              'start': 'running', 'stop': 'stopped'}
+
+    def __init__(self, factory, backend, service=None, iterations=3,
+                 timeout=10):
+        """
+        ``factory``
+          A callable taking the backend and returning a new instance
+          of the service controller to test, connected to the backend.
+        ``backend``
+          The :py:class:`SimulatedBackend`, which must be started.
+        ``service``
+          Name of the simulated service being controlled; the first of
+          the backend's services by default.
+        ``iterations``
+          Number of times to run each action.
+        ``timeout``
+          Seconds to wait for an action to take effect.
+        """
+        self.factory = factory
+        self.backend = backend
+        self.service = service or backend.services[0]
+        self.iterations = iterations
+        self.timeout = timeout
+
+    def _truth(self):
+        """
+        Return the true state of the service on every host.
+        """
+        return dict((host, self.backend.status(host, self.service))
+                    for host in self.backend.hosts)
+
+    def _check_state(self, action, host, status, violations):
+        """
+        Record a violation if ``status`` is not a valid status dict.
+        """
+        where = host and ' for host %s' % host or ''
+        if not isinstance(status, dict):
+            violations.append('%s: status%s is not a dict: %r' %
+                              (action, where, status))
+            return
+        state = status.get('state')
+        if state is None:
+            violations.append('%s: status%s has no state' % (action, where))
+        elif not isinstance(state, tuple) or len(state) != 2:
+            violations.append('%s: state%s is not a 2-tuple: %r' %
+                              (action, where, state))
+        elif [value for value in state if value not in (True, False, None)]:
+            violations.append('%s: state%s contains values other than '
+                              'True, False and None: %r' %
+                              (action, where, state))
+
+    def _check_result(self, action, result, violations):
+        """
+        Record violations if ``result`` is neither a status dict nor a
+        dict of status dicts keyed by host.
+        """
+        if (isinstance(result, dict) and 'state' not in result and
+            not [value for value in result.values()
+                 if not isinstance(value, dict)]):
+            if not result:
+                violations.append('%s: returned an empty dict' % action)
+            for host, status in result.items():
+                self._check_state(action, host, status, violations)
+        else:
+            self._check_state(action, None, result, violations)
+
+    def _converge(self, action):
+        """
+        Wait for ``action`` to take effect on every host, returning
+        the hosts on which it did not within ``timeout`` seconds.
+        """
+        check = STATE_CHECKS[action]
+        deadline = time() + self.timeout
+        while True:
+            failed = sorted(host for host, truth in self._truth().items()
+                            if not check(truth))
+            if not failed or time() >= deadline:
+                return failed
+            sleep(0.05)
+
+    def _hook(self, counts, name, result=True):
+        """
+        Return a hook which counts its calls in ``counts`` and returns
+        ``result``.
+        """
+        def hook():
+            counts[name] = counts.get(name, 0) + 1
+            return result
+        return hook
+
+    def _summary(self, durations, requests):
+        """
+        Summarize the durations of, and requests made by, the calls of
+        one action.
+        """
+        durations = sorted(durations)
+        count = len(durations)
+        return {'calls': count,
+                'mean': sum(durations) / count,
+                'p50': durations[count // 2],
+                'p95': durations[min(count - 1, int(count * 0.95))],
+                'max': durations[-1],
+                'requests_per_host': float(requests) /
+                                     (count * len(self.backend.hosts))}
+
+    def run(self):
+        """
+        Run the harness, returning a report as a dict with the keys
+        ``violations`` (a list of descriptions), ``unsupported`` (a
+        list of action names) and ``timings`` (a dict of summaries of
+        the calls of each action, by action name).
+        """
+        violations = []
+        unsupported = set()
+        durations = dict((action, []) for action in self.ACTIONS)
+        requests = dict((action, 0) for action in self.ACTIONS)
+        counts = {}
+        instance = self.factory(self.backend)
+        hooked = [action for action in self.ACTIONS
+                  if action in instance.HOOK_METHOD_NAMES]
+        for action in hooked:
+            for stage in instance.STAGES:
+                name = '%s-%s' % (stage, action)
+                instance.add_hook(name, self._hook(counts, name))
+
+        for iteration in range(self.iterations):
+            for action in self.ACTIONS:
+                if action in unsupported:
+                    continue
+                before = dict(counts)
+                sent = self.backend.total_requests()
+                pids = self._truth()
+                begin = time()
+                try:
+                    result = getattr(instance, action)()
+                except NotImplementedError:
+                    unsupported.add(action)
+                    continue
+                except Exception, error:
+                    violations.append('%s: raised %s: %s' %
+                                      (action, type(error).__name__, error))
+                    continue
+                durations[action].append(time() - begin)
+                requests[action] += self.backend.total_requests() - sent
+                self._check_result(action, result, violations)
+                if action in hooked:
+                    for stage in instance.STAGES:
+                        name = '%s-%s' % (stage, action)
+                        if counts.get(name, 0) - before.get(name, 0) != 1:
+                            violations.append('%s: %s hooks did not run '
+                                              'exactly once' % (action, name))
+                if action not in STATE_CHECKS:
+                    continue
+                failed = self._converge(action)
+                if failed:
+                    violations.append('%s: did not take effect on %s' %
+                                      (action, ', '.join(failed)))
+                if action == 'restart':
+                    same = sorted(host for host, truth in self._truth().items()
+                                  if truth[2] == pids[host][2])
+                    if same:
+                        violations.append('restart: pid did not change on '
+                                          '%s' % ', '.join(same))
+                    continue
+                # A second call should find nothing to do.
+                actions = self.backend.actions
+                try:
+                    getattr(instance, action)()
+                except Exception, error:
+                    violations.append('%s: raised %s when repeated: %s' %
+                                      (action, type(error).__name__, error))
+                if self.backend.actions != actions:
+                    violations.append('%s: sent %d actions when the service '
+                                      'was already %s' %
+                                      (action, self.backend.actions - actions,
+                                       self.STATES[action]))
+
+        # A failing pre-action hook must stop the action.
+        for action in hooked:
+            if action in unsupported or action not in STATE_CHECKS:
+                continue
+            instance = self.factory(self.backend)
+            instance.add_hook('pre-%s' % action,
+                              self._hook(counts, 'failing', False))
+            actions = self.backend.actions
+            try:
+                getattr(instance, action)()
+            except HookError:
+                pass
+            except Exception, error:
+                violations.append('%s: raised %s instead of HookError when a '
+                                  'pre-%s hook failed' %
+                                  (action, type(error).__name__, action))
+            else:
+                violations.append('%s: did not raise HookError when a '
+                                  'pre-%s hook failed' % (action, action))
+            if self.backend.actions != actions:
+                violations.append('%s: acted although a pre-%s hook failed' %
+                                  (action, action))
+
+        return {'violations': violations,
+                'unsupported': sorted(unsupported),
+                'timings': dict((action, self._summary(durations[action],
+                                                       requests[action]))
+                                for action in self.ACTIONS
+                                if durations[action])}
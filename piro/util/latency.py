@@ -0,0 +1,140 @@
+"""
+Latency tracking for service controllers which talk to remote APIs.
+
+A :py:class:`LatencyTracker` keeps an exponentially weighted moving
+average of the response time of each host, and of its variation, in
+the same way TCP estimates round-trip times. From these it derives a
+per-host timeout - short for hosts which always answer quickly, long
+for hosts which are far away or slow - and an estimate of the host's
+95th percentile response time, which :py:func:`hedged` uses to decide
+when to send a second request.
+"""
+from Queue import Empty, Queue
+import sys
+from threading import Lock, Thread
+
+from piro.util import cache
+
+
+class LatencyTracker(object):
+    """
+    Estimates the response time of each host from observations.
+    """
+
+    def __init__(self, path=None, floor=0.2, ceiling=5.0, default=1.0,
+                 alpha=0.125, beta=0.25):
+        """
+        ``path``
+          File in which to keep estimates across runs, or ``None`` to
+          keep them only in memory.
+        ``floor``, ``ceiling``
+          Bounds, in seconds, on the timeouts returned by
+          :py:meth:`timeout`.
+        ``default``
+          Timeout, in seconds, for hosts with no observations.
+        ``alpha``, ``beta``
+          Weights given to each new observation when updating the
+          average response time and its variation.
+        """
+        self.path = path
+        self.floor = floor
+        self.ceiling = ceiling
+        self.default = default
+        self.alpha = alpha
+        self.beta = beta
+        self.estimates = {}
+        self._lock = Lock()
+        if path is not None:
+            self.estimates = cache.load(path, {})
+
+    def observe(self, host, seconds):
+        """
+        Record that a request to ``host`` took ``seconds`` seconds.
+        """
+        with self._lock:
+            if host not in self.estimates:
+                self.estimates[host] = [seconds, seconds / 2]
+                return
+            mean, deviation = self.estimates[host]
+            deviation += self.beta * (abs(mean - seconds) - deviation)
+            mean += self.alpha * (seconds - mean)
+            self.estimates[host] = [mean, deviation]
+
+    def timeout(self, host, attempt=0):
+        """
+        Return the timeout, in seconds, to use for a request to
+        ``host``. ``attempt`` is the number of times the request has
+        already been tried; the timeout doubles with each attempt, up
+        to the ceiling, so a host which has become slower than its
+        estimate is given longer rather than timing out again.
+        """
+        with self._lock:
+            if host not in self.estimates:
+                timeout = self.default
+            else:
+                mean, deviation = self.estimates[host]
+                timeout = max(self.floor, mean + 4 * deviation)
+        return min(self.ceiling, timeout * 2 ** attempt)
+
+    def p95(self, host):
+        """
+        Return an estimate of the 95th percentile response time of
+        ``host`` in seconds, or ``None`` if nothing is known about it.
+        """
+        with self._lock:
+            if host not in self.estimates:
+                return None
+            mean, deviation = self.estimates[host]
+        # The mean deviation is about 0.8 standard deviations.
+        return mean + 2 * deviation
+
+    def save(self):
+        """
+        Write the estimates to ``path``, if one was given.
+        """
+        if self.path is None:
+            return
+        with self._lock:
+            estimates = dict(self.estimates)
+        cache.save(self.path, estimates)
+
+
+def hedged(fun, delay):
+    """
+    Call ``fun``, and if it has not returned after ``delay`` seconds,
+    call it again concurrently. Return the result of whichever call
+    succeeds first; if both fail, re-raise the error of the first call
+    to fail. A ``delay`` of ``None`` disables hedging.
+    """
+    if delay is None:
+        return fun()
+    results = Queue()
+
+    def call():
+        try:
+            results.put((True, fun()))
+        except Exception:
+            results.put((False, sys.exc_info()))
+
+    def start():
+        thread = Thread(target=call)
+        thread.daemon = True
+        thread.start()
+
+    start()
+    calls = 1
+    errors = []
+    try:
+        first = results.get(timeout=delay)
+    except Empty:
+        start()
+        calls = 2
+        first = results.get()
+    while True:
+        success, value = first
+        if success:
+            return value
+        errors.append(value)
+        if len(errors) == calls:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        first = results.get()
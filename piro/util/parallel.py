@@ -0,0 +1,44 @@
+"""
+Helpers for running service control calls concurrently.
+"""
+import sys
+from threading import Lock, Thread
+
+
+def pmap(fun, items, workers=16):
+    """
+    Call ``fun`` on each of ``items`` using up to ``workers`` threads
+    and return the results as a list in the same order as
+    ``items``. If any call raises an exception, the remaining calls
+    are allowed to finish and then the first exception raised is
+    re-raised in the calling thread.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    lock = Lock()
+    pending = iter(range(len(items)))
+
+    def work():
+        while True:
+            with lock:
+                try:
+                    index = pending.next()
+                except StopIteration:
+                    return
+            try:
+                results[index] = fun(items[index])
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+
+    threads = [Thread(target=work)
+               for i in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
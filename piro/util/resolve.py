@@ -0,0 +1,99 @@
+"""
+Concurrent host name resolution with a cache.
+
+Resolving the names of thousands of hosts one request at a time can
+take longer than the requests themselves. A :py:class:`Resolver`
+resolves every host up front, concurrently, and remembers the
+addresses for a while - in memory, and optionally on disk so that
+later runs can skip the lookups altogether.
+
+Every address of a host is kept, in the order the system resolver
+prefers them, so that a caller which can not connect to the first -
+for example ``::1`` for ``localhost`` when the service only listens on
+``127.0.0.1`` - can fall back to the next, as connecting by name
+would.
+"""
+import socket
+from threading import Lock
+from time import time
+
+from piro.util import cache
+from piro.util.parallel import pmap
+
+
+class Resolver(object):
+    """
+    Resolves host names to addresses, caching the results.
+    """
+
+    def __init__(self, path=None, ttl=300):
+        """
+        ``path``
+          File in which to keep addresses across runs, or ``None`` to
+          keep them only in memory.
+        ``ttl``
+          Seconds for which resolved addresses may be reused.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.cache = {}
+        self._lock = Lock()
+        if path is not None:
+            self.cache = cache.load(path, {})
+
+    def resolve(self, host, port):
+        """
+        Return the list of addresses of ``host``, most preferred first,
+        from the cache if possible. Raises ``socket.error`` if the host
+        can not be resolved.
+        """
+        with self._lock:
+            addresses, expires = self.cache.get(host, (None, 0))
+        if addresses is not None and time() < expires:
+            # Caches written by older versions hold a single address.
+            if isinstance(addresses, basestring):
+                addresses = [addresses]
+            return list(addresses)
+        addresses = []
+        for entry in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+            if entry[4][0] not in addresses:
+                addresses.append(entry[4][0])
+        with self._lock:
+            self.cache[host] = [addresses, time() + self.ttl]
+        return list(addresses)
+
+    def resolve_all(self, hosts, port, workers=16):
+        """
+        Resolve many hosts concurrently. Returns a tuple of the form
+        ``(addresses, failures)``, where ``addresses`` is a dict
+        mapping each host which was resolved to its list of addresses,
+        and ``failures`` is a dict mapping each host which was not to
+        a description of the error.
+        """
+        def resolve(host):
+            try:
+                return self.resolve(host, port), None
+            except socket.error, error:
+                return None, str(error)
+        addresses = {}
+        failures = {}
+        for host, (address, error) in zip(hosts, pmap(resolve, hosts,
+                                                      workers=workers)):
+            if error is None:
+                addresses[host] = address
+            else:
+                failures[host] = error
+        return addresses, failures
+
+    def save(self):
+        """
+        Write the unexpired addresses to ``path``, if one was given.
+        """
+        if self.path is None:
+            return
+        now = time()
+        with self._lock:
+            addresses = dict((host, entry)
+                             for host, entry in self.cache.items()
+                             if entry[1] > now)
+        cache.save(self.path, addresses)
@@ -0,0 +1,131 @@
+"""
+Retry policies for service controllers which talk to remote APIs over
+unreliable networks.
+
+A :py:class:`RetryPolicy` decides whether a failed call should be
+retried, and how long to back off before doing so. A policy may share
+a :py:class:`RetryBudget` with other policies so that the total number
+of retries across a whole run stays proportional to the number of
+requests actually made; this keeps a partial outage from being turned
+into a retry storm.
+"""
+import random
+import socket
+from threading import Lock
+from time import sleep
+import urllib2 as url
+
+
+class RetryBudget(object):
+    """
+    Limits the number of retries to a fraction of the number of
+    requests made, plus a small fixed allowance so that short runs
+    can still retry.
+    """
+
+    def __init__(self, ratio=0.2, minimum=10):
+        """
+        ``ratio``
+          Number of retries permitted per request made.
+        ``minimum``
+          Number of retries permitted regardless of ``ratio``.
+        """
+        self.ratio = ratio
+        self.minimum = minimum
+        self.requests = 0
+        self.retries = 0
+        self._lock = Lock()
+
+    def request(self):
+        """
+        Record that a request was made.
+        """
+        with self._lock:
+            self.requests += 1
+
+    def withdraw(self):
+        """
+        Attempt to spend one retry from the budget. Returns True if
+        the retry is permitted, False if the budget is exhausted.
+        """
+        with self._lock:
+            if self.retries >= self.minimum + self.ratio * self.requests:
+                return False
+            self.retries += 1
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Describes which failures are transient and how to retry them.
+    """
+
+    def __init__(self, attempts=3, backoff=0.1, multiplier=2.0,
+                 max_backoff=2.0,
+                 exceptions=(url.URLError, socket.error),
+                 codes=(502, 503, 504), budget=None):
+        """
+        ``attempts``
+          Maximum number of attempts per call, including the first.
+        ``backoff``
+          Seconds to wait before the first retry.
+        ``multiplier``
+          Factor by which the back off grows after each retry.
+        ``max_backoff``
+          Upper bound, in seconds, on a single back off.
+        ``exceptions``
+          Tuple of exception classes considered transient.
+        ``codes``
+          HTTP status codes considered transient. An ``HTTPError``
+          with any other code is never retried, even though it is a
+          ``URLError``.
+        ``budget``
+          A :py:class:`RetryBudget` shared by every call made with
+          this policy, or ``None`` for no overall limit.
+        """
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.multiplier = multiplier
+        self.max_backoff = max_backoff
+        self.exceptions = tuple(exceptions)
+        self.codes = set(codes)
+        self.budget = budget
+
+    def transient(self, error):
+        """
+        Return True if ``error`` is worth retrying.
+        """
+        if isinstance(error, url.HTTPError):
+            return error.code in self.codes
+        return isinstance(error, self.exceptions)
+
+    def delay(self, retry):
+        """
+        Return the number of seconds to back off before retry number
+        ``retry`` (counting from 1). Jitter is applied so that many
+        clients failing at once do not retry in lock-step.
+        """
+        delay = min(self.max_backoff,
+                    self.backoff * self.multiplier ** (retry - 1))
+        return delay * random.uniform(0.5, 1.0)
+
+    def call(self, fun, *args, **kwargs):
+        """
+        Call ``fun`` with the given arguments, retrying transient
+        failures. Returns a tuple ``(result, retries)``. The last
+        error is re-raised if attempts or the budget run out.
+        """
+        retries = 0
+        while True:
+            if self.budget is not None:
+                self.budget.request()
+            try:
+                return fun(*args, **kwargs), retries
+            except Exception, error:
+                if (not self.transient(error) or
+                    retries + 1 >= self.attempts or
+                    (self.budget is not None and
+                     not self.budget.withdraw())):
+                    raise
+            retries += 1
+            sleep(self.delay(retries))
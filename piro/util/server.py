@@ -0,0 +1,33 @@
+"""
+A small HTTP server for the listeners piro runs alongside its work,
+such as the :py:class:`status collector
+<piro.collector.StatusCollector>`.
+"""
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server which handles each request in its own thread, so a
+    slow client never holds up the others, and which runs in the
+    background without keeping piro from exiting.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def start(self):
+        """
+        Start serving requests in a background thread.
+        """
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """
+        Stop serving requests and close the listening socket.
+        """
+        self.shutdown()
+        self.server_close()